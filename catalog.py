@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+This module provides the incident catalog: an SQLite database next to the
+incidents (legal/catalog.sqlite) holding one row per incident (trigger
+source, peak g, time window, sizes) and one per referenced file (sizes and
+hashes). It is updated in one transaction whenever an incident is saved or
+deleted through the IncidentStore, so listing and retention queries do not
+have to walk and stat the legal folder. The signed manifests stay the source
+of truth; the catalog can be rebuilt from them at any time.
+The catalog is only an index: if it is damaged, it can be deleted and is
+re-created from the manifests.
+Can also be used as stand-alone script to query it.
+Classes:
+    IncidentCatalog
+Functions:
+    delete_catalog
+    main
+"""
+import os
+import json
+import sqlite3
+from threading import Lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS incidents (
+    incident TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    source TEXT,
+    peak_g REAL,
+    window_start REAL,
+    window_end REAL,
+    segments INTEGER NOT NULL,
+    stills INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    info TEXT
+);
+CREATE INDEX IF NOT EXISTS incidents_created ON incidents (created);
+CREATE INDEX IF NOT EXISTS incidents_peak_g ON incidents (peak_g);
+CREATE TABLE IF NOT EXISTS files (
+    incident TEXT NOT NULL REFERENCES incidents (incident) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    blob TEXT NOT NULL,
+    PRIMARY KEY (incident, name)
+);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+"""
+
+# manifest keys that have their own column
+COLUMN_KEYS = ("incident", "created", "source", "peak_g", "files", "signature")
+
+
+def _segment_start(name):
+    # '<prefix>_<timestamp>-<salt>-<counter>.<type>' (as INCIDENT_ copy)
+    fileid = name.rsplit(".", 1)[0].rsplit("_", 1)[-1]
+    try:
+        return int(fileid.split("-")[0])
+    except ValueError:
+        return None
+
+
+class IncidentCatalog():
+    """
+    SQLite index of the incidents of one legal folder.
+    Keyword Arguments:
+        path -- the database file, e.g. /opt/dashcam/legal/catalog.sqlite
+    """
+    FILENAME = "catalog.sqlite"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # shared by the threads of the dashcam; serialized by the lock
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA foreign_keys=ON")
+            self.connection.executescript(SCHEMA)
+
+    def _insert(self, manifest):
+        files = manifest.get("files", [])
+        segment_starts = [
+            start
+            for start in (_segment_start(entry["name"]) for entry in files)
+            if start is not None
+        ]
+        stills = sum(entry["name"].endswith(".jpg") for entry in files)
+        self.connection.execute("DELETE FROM incidents WHERE incident = ?", (manifest["incident"],))
+        self.connection.execute(
+            "INSERT INTO incidents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                manifest["incident"], manifest["created"], manifest.get("source"),
+                manifest.get("peak_g"), min(segment_starts, default=None),
+                manifest["created"], len(files) - stills, stills,
+                sum(entry["size"] for entry in files),
+                json.dumps({
+                    key: value
+                    for key, value in manifest.items()
+                    if key not in COLUMN_KEYS
+                }),
+            )
+        )
+        self.connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+            [
+                (manifest["incident"], entry["name"], entry["size"], entry["sha256"], entry["blob"])
+                for entry in files
+            ]
+        )
+
+    def add(self, manifest):
+        """
+        Add (or replace) an incident from its manifest; one transaction.
+        """
+        with self.lock, self.connection:
+            self._insert(manifest)
+
+    def remove(self, incident):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM incidents WHERE incident = ?", (incident,))
+
+    def rebuild(self, store):
+        """
+        Re-create the catalog from the manifests of an IncidentStore.
+        Returns: number of incidents
+        """
+        manifests = []
+        for incident in store.incidents():
+            try:
+                manifests.append(store.read_manifest(incident))
+            except (OSError, ValueError) as error:
+                print(f"WARNING! Unreadable manifest of '{incident}': {error}")
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM incidents")
+            for manifest in manifests:
+                self._insert(manifest)
+        return len(manifests)
+
+    def sync(self, store):
+        """
+        Rebuild if the catalog does not list the same incidents as the store,
+        e.g. after incidents were deleted by hand or on the first run.
+        Returns: True if rebuilt
+        """
+        cataloged = {row[0] for row in self._query("SELECT incident FROM incidents")}
+        if cataloged == set(store.incidents()):
+            return False
+        self.rebuild(store)
+        return True
+
+    def _query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def incidents(self, since=None, until=None, min_peak_g=None, source=None):
+        """
+        Returns: rows of the incidents matching all given filters, oldest first
+        """
+        conditions, parameters = [], []
+        for condition, value in (
+                ("created >= ?", since), ("created < ?", until),
+                ("peak_g >= ?", min_peak_g), ("source = ?", source)):
+            if value is not None:
+                conditions.append(condition)
+                parameters.append(value)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._query(f"SELECT * FROM incidents {where} ORDER BY created", parameters)
+
+    def total_size(self):
+        """
+        Returns: dict with the number of incidents, the bytes all incidents
+                 refer to and the bytes stored (every chunk counted once)
+        """
+        row = self._query(
+            "SELECT (SELECT COUNT(*) FROM incidents) AS incidents, "
+            "(SELECT COALESCE(SUM(size), 0) FROM files) AS referenced, "
+            "(SELECT COALESCE(SUM(size), 0) FROM "
+            "(SELECT MAX(size) AS size FROM files GROUP BY sha256)) AS stored"
+        )[0]
+        return dict(row)
+
+    def retention(self, older_than):
+        """
+        What deleting all incidents created before older_than would free.
+        Returns: (rows of those incidents, bytes freed)
+        """
+        rows = self.incidents(until=older_than)
+        # chunks only referenced by the old incidents
+        freed = self._query(
+            "SELECT COALESCE(SUM(size), 0) FROM ("
+            "SELECT MAX(files.size) AS size FROM files "
+            "JOIN incidents USING (incident) GROUP BY sha256 "
+            "HAVING MAX(incidents.created) < ?)",
+            (older_than,)
+        )[0][0]
+        return rows, freed
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def delete_catalog(path):
+    """
+    Delete a catalog database including its WAL files, e.g. if it is corrupt.
+    """
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(f"{path}{suffix}")
+        except FileNotFoundError:
+            pass
+
+
+def _parse_time(value):
+    # epoch seconds or ISO date/time (local time)
+    from datetime import datetime
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def _print_incidents(rows):
+    from datetime import datetime
+    for row in rows:
+        peak_g = f"{row['peak_g']:.2f}g" if row["peak_g"] is not None else "-"
+        print(
+            f"{row['incident']}  {datetime.fromtimestamp(row['created']).isoformat(' ', 'seconds')}  "
+            f"{row['source'] or '-':8}  {peak_g:>6}  {row['segments']} segments  "
+            f"{row['stills']} stills  {row['size']} bytes"
+        )
+
+
+def main():
+    import argparse
+    from time import time, perf_counter
+
+    parser = argparse.ArgumentParser(description="Query the dashcam incident catalog.")
+    parser.add_argument(
+        "-l", "--legal_path", metavar="P", type=str, default="/opt/dashcam/legal",
+        help="Location of the legal (incident) folder."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="List incidents, oldest first.")
+    list_parser.add_argument("--since", metavar="T", type=_parse_time, help="ISO date or epoch")
+    list_parser.add_argument("--until", metavar="T", type=_parse_time, help="ISO date or epoch")
+    list_parser.add_argument("--min_peak_g", metavar="G", type=float)
+    list_parser.add_argument("--source", metavar="S", type=str, help="e.g. button or g_force")
+    subparsers.add_parser("size", help="Number of incidents and evidence size.")
+    retention_parser = subparsers.add_parser(
+        "retention", help="Incidents older than the given days and what deleting them frees."
+    )
+    retention_parser.add_argument("days", metavar="DAYS", type=float)
+    subparsers.add_parser("rebuild", help="Re-create the catalog from the manifests.")
+    args = parser.parse_args()
+
+    catalog = IncidentCatalog(os.path.join(args.legal_path, IncidentCatalog.FILENAME))
+    start = perf_counter()
+    if args.command == "list":
+        rows = catalog.incidents(args.since, args.until, args.min_peak_g, args.source)
+        _print_incidents(rows)
+        print(f"{len(rows)} incidents.")
+    elif args.command == "size":
+        sizes = catalog.total_size()
+        print(
+            f"{sizes['incidents']} incidents refer to {sizes['referenced']} bytes; "
+            f"{sizes['stored']} bytes stored."
+        )
+    elif args.command == "retention":
+        rows, freed = catalog.retention(time() - args.days * 86400)
+        _print_incidents(rows)
+        print(f"Deleting these {len(rows)} incidents frees {freed} bytes.")
+    elif args.command == "rebuild":
+        from store import IncidentStore
+        count = catalog.rebuild(IncidentStore(args.legal_path))
+        print(f"Catalog rebuilt from {count} manifests.")
+    print(f"({(perf_counter() - start) * 1000:.1f}ms)")
+    catalog.close()
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+This module reads the optional configuration file of the dashcam: an INI file
+with a [dashcam] section whose keys are the keyword arguments of Dashcam,
+e.g.
+
+    [dashcam]
+    sequence_length = 30
+    g_force_limit = 2.5
+
+Values are converted to the expected type of the argument: from TYPES for
+the arguments whose default does not tell (e.g. None), otherwise the type of
+the current value. Tuples are given as integers separated by spaces or commas,
+e.g. still_resolution = 3280 1845.
+Functions:
+    read_config
+    convert_value
+"""
+import configparser
+
+SECTION = "dashcam"
+
+# expected types of the arguments whose default is None or does not tell
+TYPES = {
+    "resolution": tuple,
+    "preview_resolution": tuple,
+    "still_resolution": tuple,
+    "sensor_spi_channels": tuple,
+    "preview_port": int,
+    "sampler_priority": int,
+    "pin_sensor_int": int,
+    "upload_bandwidth": int,
+    "upload_endpoint": str,
+    "telemetry_path": str,
+    "g_force_limit": float,
+}
+
+
+def convert_value(raw, expected_type):
+    """
+    Convert a config string to expected_type; 'none' gives None.
+    """
+    raw = raw.strip()
+    if raw.lower() == "none":
+        return None
+    if expected_type is bool:
+        if raw.lower() not in configparser.RawConfigParser.BOOLEAN_STATES:
+            raise ValueError(f"'{raw}' is no boolean")
+        return configparser.RawConfigParser.BOOLEAN_STATES[raw.lower()]
+    if expected_type in (tuple, list):
+        return expected_type(int(val) for val in raw.replace(",", " ").split())
+    if expected_type is int:
+        # int arguments may take fractions too
+        return int(raw) if raw.lstrip("+-").isdigit() else float(raw)
+    if expected_type is float:
+        return float(raw)
+    if expected_type is str:
+        return raw
+    for convert in (int, float):
+        try:
+            return convert(raw)
+        except ValueError:
+            pass
+    return raw
+
+
+def read_config(path, current_values):
+    """
+    Read the [dashcam] section of a config file.
+    Keyword Arguments:
+        path -- the INI file
+        current_values -- dict of the current Dashcam keyword arguments; used
+                          to detect unknown keys and for the types not in TYPES
+    Returns: (dict of converted values, list of unknown keys)
+    Raises: OSError if unreadable, ValueError on malformed files or values
+    """
+    parser = configparser.ConfigParser()
+    try:
+        with open(path) as file:
+            parser.read_file(file)
+    except configparser.Error as error:
+        raise ValueError(f"Malformed config file '{path}': {error}")
+    if not parser.has_section(SECTION):
+        return {}, []
+    values, unknown = {}, []
+    for key, raw in parser.items(SECTION):
+        if key not in current_values:
+            unknown.append(key)
+            continue
+        try:
+            values[key] = convert_value(
+                raw, TYPES.get(key, type(current_values[key]))
+            )
+        except ValueError as error:
+            raise ValueError(f"Invalid value for '{key}' in '{path}': {error}")
+    return values, unknown
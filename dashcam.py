@@ -1,15 +1,77 @@
 #!/usr/bin/env python3
 import os
-import shutil
+import signal
+import sqlite3
 import argparse
 import picamera
+from io import BytesIO
+from queue import Queue
 from led import LED
 from switch import Switch
-from time import time, sleep
-from threading import Thread, Lock
+from time import time, sleep, monotonic, clock_gettime, CLOCK_BOOTTIME
+from threading import Thread, Lock, Event
 from random import randbytes
-from movement import Adxl345Spi
-from math import fabs
+from movement import Adxl345, Adxl345Spi, Adxl345I2C, FusedAdxl345
+from preview import PreviewServer
+from segment import SegmentWriter, SegmentIndex
+from recovery import recover_previous_session
+import events
+from events import EventBus
+from metrics import Metrics
+from sampler import PeriodicSampler
+from store import IncidentStore
+from catalog import IncidentCatalog, delete_catalog
+from isolation import ProcessSupervisor
+from upload import Uploader
+from detection import peak_g, exceeds_limit, TelemetryWriter
+from config import read_config
+from health import RecorderWatchdog, sd_notify, watchdog_period
+
+# parts of the dashcam that can run in separate processes; ui is the
+# supervisor's part (buttons, power/info LEDs)
+COMPONENTS = ("recorder", "sensor", "incident", "ui")
+
+# keyword arguments that can be changed while running -> Dashcam attribute;
+# sequence_length takes effect with the next segment, the others at once
+HOT_RELOADABLE = {
+    "sequence_length": "video_sequence_seconds",
+    "sequence_count": "video_sequence_count",
+    "g_force_limit": "g_force_limit",
+    "led_pwr_dim_perc": "pin_led_pwr_dim_percent",
+    "still_count": "still_count",
+    "still_quality": "still_quality",
+    "upload_interval": "upload_interval",
+}
+
+# per camera.revision the full sensor resolution and the highest framerate
+# of its full resolution (unbinned) mode
+SENSOR_FULL_MODES = {
+    "ov5647": ((2592, 1944), 15),
+    "imx219": ((3280, 2464), 15),
+    "imx477": ((4056, 3040), 10),
+}
+
+# data rate of the sensor while it detects shocks itself: 100 Hz, so its 32
+# entry FIFO spans 320ms around the interrupt instead of 10ms at 3200 Hz and
+# still holds the shock once read after the GPIO callback
+SENSOR_INTERRUPT_DATA_RATE_LEVEL = 5
+
+# seconds an incident waits for its still burst to be written
+STILL_BURST_TIMEOUT = 10
+
+# fallback reference if the kernel does not tell us our start time
+MODULE_LOAD_TIME = monotonic()
+
+
+def get_process_uptime():
+    # seconds since the kernel started this process, so interpreter start
+    # and imports are part of the measured startup time
+    try:
+        with open("/proc/self/stat") as file:
+            start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+        return clock_gettime(CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return monotonic() - MODULE_LOAD_TIME
 
 
 def get_usb_storage_device(desired_device=None):
@@ -73,7 +135,19 @@ class Dashcam():
             video_type="h264", video_name_prefix="video-dashcam", bitrate = 17000000,
             framerate=30, video_file_path="/opt/dashcam", pin_btn_pwr=11, pin_btn_cpy=12,
             pin_btn_stop=13, pin_btn_info=15, pin_led_cpy=29, pin_led_pwr=33,
-            pin_led_info=37, led_pwr_dim_perc=5, g_force_limit=1.5, salt_bytes=4):
+            pin_led_info=37, led_pwr_dim_perc=5, g_force_limit=1.5, salt_bytes=4,
+            preview_port=None, preview_format="mjpeg", preview_resolution=(640, 360),
+            recovery_segment_count=1, sensor_bus="spi", sensor_i2c_bus=1,
+            sensor_i2c_address=Adxl345I2C.ADDR_I2C_DEFAULT, g_force_sample_rate=2,
+            sampler_priority=None, pin_sensor_int=None,
+            manifest_key_path="/opt/dashcam/.manifest.key", isolation="thread",
+            upload_endpoint=None, upload_bandwidth=None, upload_interval=300,
+            still_count=5, still_resolution=None, still_quality=90,
+            telemetry_path=None, stall_timeout=5, recovery_timeout=20,
+            sensor_spi_channels=(0,), sensor_fusion="agree"):
+        # kept to build the component Dashcams of other processes
+        self.init_kwargs = dict(locals())
+        del self.init_kwargs["self"], self.init_kwargs["isolation"]
         self.pin_btn_cpy = pin_btn_cpy
         self.pin_btn_pwr = pin_btn_pwr
         self.pin_btn_info = pin_btn_info
@@ -85,6 +159,19 @@ class Dashcam():
         self.pin_blink_seconds = 2
         self.pin_blink_on_seconds = 0.1
         self.g_force_limit = g_force_limit
+        self.sensor_bus = sensor_bus if sensor_bus in ("spi", "i2c") else "spi"
+        self.sensor_i2c_bus = sensor_i2c_bus
+        self.sensor_i2c_address = sensor_i2c_address
+        # more than one channel: the sensors are read and detected as one
+        self.sensor_spi_channels = tuple(sensor_spi_channels)
+        self.sensor_fusion = sensor_fusion
+        self.g_force_sample_rate = g_force_sample_rate
+        self.sampler_priority = sampler_priority
+        self.g_force_sampler = None
+        # INT1 of the sensor; None means the sensor is polled by the sampler
+        self.pin_sensor_int = pin_sensor_int
+        self.SENSOR_int = None
+        self.sensor_lock = Lock()
 
         self.video_sequence_seconds = sequence_length
         self.video_sequence_count = sequence_count
@@ -96,30 +183,93 @@ class Dashcam():
         self.video_bit_rate = bitrate
         self.video_frame_rate = framerate
 
+        # live preview is optional; None means no server at all
+        self.preview_port = preview_port
+        self.preview_format = preview_format
+        self.preview_resolution = preview_resolution
+        self.preview_server = None
+
+        # stills of the incident moment, taken from the video port while
+        # recording; with still_resolution the camera runs at that (e.g. full
+        # sensor) resolution and the recording is scaled down to the video
+        # resolution
+        self.still_count = still_count
+        self.still_resolution = still_resolution
+        self.still_quality = still_quality
+        self.still_path = f"{self.video_file_path}/.stills"
+        self.still_queue = Queue()
+        # started on demand, still_count may be raised by a reload
+        self.still_threads_started = False
+        self.still_lock = Lock()
+
         # using a salt to not eventually overwrite files
         # after an unexpected reboot in car; is like
         # a unique identifier for an ongoing record session
         self.video_name_salt = randbytes(salt_bytes).hex()
 
-        self.LED_data = LED(self.pin_led_cpy)
-        self.LED_power = LED(self.pin_led_pwr)
-        self.LED_info = LED(self.pin_led_info)
-
-
-        self.BTN_data = Switch(self.pin_btn_cpy)
-        self.BTN_power = Switch(self.pin_btn_pwr)
-        self.BTN_stop = Switch(self.pin_btn_stop)
-        self.BTN_info = Switch(self.pin_btn_info)
+        # tail of the previous session found at startup; kept within the
+        # regular sequence count until this session ends
+        self.recovery_segment_count = recovery_segment_count
+        self.protected_video_files = []
+        self.segment_index = None
+        # hashes computed while recording, by segment filename
+        self.segment_digests = {}
+        self.manifest_key_path = manifest_key_path
+        # incidents are pushed there whenever it is reachable
+        self.upload_endpoint = upload_endpoint
+        self.upload_bandwidth = upload_bandwidth
+        self.upload_interval = upload_interval
+        self.upload_requested = Event()
+
+        # LEDs, buttons, sensor and camera are created in start(); recording
+        # begins first, everything else is initialised afterwards in parallel
+        self.LED_data = None
+        self.LED_power = None
+        self.LED_info = None
+        self.BTN_data = None
+        self.BTN_power = None
+        self.BTN_stop = None
+        self.BTN_info = None
+        self.adxl345 = None
+        self.camera = None
+        self.peripherals_ready = Event()
+        self.first_frame_ready = Event()
+        self.startup_stats = {}
 
         self.file_lock = Lock()
         self.camera_lock = Lock()
 
-        self.adxl345 = Adxl345Spi()
+        # threads talk to each other via events instead of polling attributes
+        self.bus = EventBus()
+        self.metrics = Metrics()
+
+        # "thread": everything in this process; "process": one process per
+        # component, coordinated by this one
+        self.isolation = isolation if isolation in ("thread", "process") else "thread"
+        self.components = set(COMPONENTS)
+        self.process_role = None
+        self.supervisor = None
+        # callables(t, x, y, z) every sensor sample is handed to
+        self.sample_sinks = []
+        self.telemetry = None
+        # folder to record the sensor samples into, for detection.py
+        self.telemetry_path = telemetry_path
+        # re-read on reload_config(), e.g. on SIGHUP
+        self.config_path = None
+
+        # a stalled recorder is re-created in-process; if that takes longer
+        # than recovery_timeout, systemd's watchdog restarts the service
+        self.watchdog = RecorderWatchdog(stall_timeout=stall_timeout)
+        self.recovery_timeout = recovery_timeout
+        # recorder threads of older cameras stop once this is increased
+        self.recorder_generation = 0
+        self.current_segment = None
+        self.last_split_time = None
+        # length the current segment was started with; sequence_length may
+        # be changed meanwhile by a reload
+        self.current_segment_seconds = None
+        self.segment_lock = Lock()
 
-        self.camera = picamera.PiCamera(
-            resolution=self.video_resolution,
-            framerate=self.video_frame_rate
-        )
         self.camera_state = 0 #0: off, 1: turndown, 2: on
         self.info_led_state = 0
         self.segment_ctr = 0
@@ -131,11 +281,48 @@ class Dashcam():
     def set_video_path(self, path):
         self.video_file_path = path
         self.video_file_path_legal = f"{self.video_file_path}/legal"
+        self.still_path = f"{self.video_file_path}/.stills"
 
     def __del__(self):
         del self.LED_data, self.LED_power
 
+    def _mark_startup(self, milestone):
+        # restarts of the recording (buttons, recovery) are no startup
+        if milestone in self.startup_stats:
+            return
+        self.startup_stats[milestone] = get_process_uptime()
+        self.metrics.set_gauge(f"startup.{milestone}", self.startup_stats[milestone])
+
+    def _set_camera_state(self, state):
+        self.camera_state = state
+        self.bus.publish(events.STATE_CHANGED, key="camera_state", value=state)
+
+    def _on_first_segment_write(self, segment):
+        if self.first_frame_ready.is_set():
+            return
+        self._mark_startup("first_frame")
+        self.first_frame_ready.set()
+        print(
+            "Startup: first encoded frame after "
+            f"{self.startup_stats['first_frame']:.3f}s ("
+            + ", ".join(
+                f"{milestone} {seconds:.3f}s"
+                for milestone, seconds in self.startup_stats.items()
+                if milestone != "first_frame"
+            ) + ")."
+        )
+
     def _dashcam_video_thread(self):
+        generation = self.recorder_generation
+        try:
+            self._record(generation)
+        except Exception as error:
+            # e.g. wait_recording raising on encoder errors; the watchdog
+            # notices the dead thread and re-creates the camera
+            self.metrics.increment("recorder.errors")
+            print(f"WARNING! Recorder stopped: {error}")
+
+    def _record(self, generation):
         self.video_filename = (
             f"{self.video_name_prefix}_"
             f"{int(time())}-{self.video_name_salt}-"
@@ -143,12 +330,22 @@ class Dashcam():
         )
         video_path = f"{self.video_file_path}/{self.video_filename}"
         print(f"Recording to '{video_path}'.")
+        segment = SegmentWriter(video_path, on_first_write=self._on_first_segment_write)
+        self.segment_index.append(
+            "started", file=self.video_filename, session=self.video_name_salt
+        )
+        self.current_segment = segment
+        self.last_split_time = monotonic()
+        self.current_segment_seconds = self.video_sequence_seconds
         self.camera.start_recording(
-            video_path, format=self.video_type, bitrate=self.video_bit_rate
+            segment, format=self.video_type, bitrate=self.video_bit_rate,
+            resize=self.video_resolution if self.still_resolution else None
         )
-        self.camera.wait_recording(self.video_sequence_seconds)
+        self._mark_startup("recording_started")
+        self.bus.publish(events.SEGMENT_STARTED, file=self.video_filename)
+        self.camera.wait_recording(self.current_segment_seconds)
 
-        while self.camera_state > 1:
+        while self.camera_state > 1 and generation == self.recorder_generation:
             self.segment_ctr += 1
             tmp_video_filename = (
                 f"{self.video_name_prefix}_"
@@ -157,17 +354,68 @@ class Dashcam():
             )
             video_path = f"{self.video_file_path}/{tmp_video_filename}"
             print(f"Recording to '{video_path}'.")
-            self.camera.split_recording(video_path)
-            # as the copy thread callback might be a bit too fast,
-            # we manage to set the final new filename AFTER the switch
-            # which guarantees, that the file is really finished.
+            next_segment = SegmentWriter(video_path)
+            self.segment_index.append(
+                "started", file=tmp_video_filename, session=self.video_name_salt
+            )
+            split_start = monotonic()
+            self.camera.split_recording(next_segment)
+            self.metrics.set_gauge("recorder.split_ms", (monotonic() - split_start) * 1000)
+            self.current_segment = next_segment
+            self.last_split_time = monotonic()
+            self.current_segment_seconds = self.video_sequence_seconds
+            # the new filename is announced before the old segment is closed:
+            # whoever still reads the old name will see its close afterwards
             self.video_filename = tmp_video_filename
-            self.camera.wait_recording(self.video_sequence_seconds)
+            self.bus.publish(events.SEGMENT_STARTED, file=self.video_filename)
+            # picamera does not close output objects it did not open itself
+            self._close_segment(segment)
+            segment = next_segment
+            self.camera.wait_recording(self.current_segment_seconds)
+        if generation != self.recorder_generation:
+            # the camera was re-created meanwhile; it is not ours anymore
+            self._close_segment(segment)
+            return
         self.camera.stop_recording()
-        self.camera_state = 0
+        self._close_segment(segment)
+        self.current_segment = None
+        self._set_camera_state(0)
+
+    def _close_segment(self, segment):
+        # the recorder and the watchdog may both try after a stall
+        with self.segment_lock:
+            if segment.closed:
+                return
+            segment.close()
+        entry = self.segment_index.append(
+            "closed", file=segment.filename, session=self.video_name_salt,
+            size=segment.bytes_written, **segment.digests()
+        )
+        # only incident handling needs them; it drops them with the file
+        if "incident" in self.components:
+            self.segment_digests[segment.filename] = entry
+        # digests travel with the event for incident handling in another process
+        self.bus.publish(events.SEGMENT_CLOSED, **entry)
+
+    def _recover_previous_session(self):
+        self.protected_video_files = recover_previous_session(
+            self.segment_index, self.video_file_path, self.video_name_prefix,
+            self.video_type, self.video_name_salt, self.recovery_segment_count
+        )[:self.video_sequence_count]
 
 
     def _dashcam_file_cleanup_thread(self):
+        # subscribe first, so no new segment is missed during the recovery
+        subscription = self.bus.subscribe(events.SEGMENT_STARTED)
+        # must be done before the first cleanup might delete the footage
+        if self.recovery_segment_count > 0:
+            self._recover_previous_session()
+        # entries of files deleted meanwhile (e.g. by hand) are gone for good
+        self.segment_index.compact(
+            set(self.get_directory_file_list(self.video_file_path, self.video_type)),
+            keep_session=self.video_name_salt
+        )
+        self.segment_digests.update(self.segment_index.closed_digests())
         while True:
             self.file_lock.acquire()
 
@@ -193,9 +441,33 @@ class Dashcam():
                         f"WARNING! File '{self.video_file_path}/{del_video_file}'"
                         " is gone. Ignoreing file. Continue"
                     )
+                self.segment_digests.pop(del_video_file, None)
+            if delete_video_file_list:
+                # keeps the index (and its reading at startup) small
+                self.segment_index.forget(set(delete_video_file_list))
+
+            self._delete_orphaned_stills()
 
             self.file_lock.release()
-            sleep(self.video_sequence_seconds)
+            # a new segment is the only reason for a file to become obsolete
+            subscription.get()
+
+    def _delete_orphaned_stills(self):
+        # stills of incidents that were not saved (e.g. skipped as part of
+        # the same crash) are kept no longer than the footage of that moment
+        max_age = self.video_sequence_count * self.video_sequence_seconds
+        try:
+            stills = os.listdir(self.still_path)
+        except FileNotFoundError:
+            return
+        for still in stills:
+            path = f"{self.still_path}/{still}"
+            try:
+                if time() - os.path.getmtime(path) > max_age:
+                    print(f"DELETE orphaned still '{path}'")
+                    os.remove(path)
+            except FileNotFoundError:
+                continue
 
     def _led_power_heartbeat(self, LED):
         LED.set_duty_cycle(self.pin_led_pwr_dim_percent)
@@ -207,8 +479,7 @@ class Dashcam():
         LED.set_duty_cycle(0)
 
     def _dashcam_powerled_thread(self):
-        round_cntr = 0
-        round_time = 0.5
+        subscription = self.bus.subscribe(events.STATE_CHANGED)
 
         LED_is_on = True
 
@@ -218,12 +489,16 @@ class Dashcam():
         }
 
         while True:
+            # None: nothing to animate, sleep until the next state change
+            round_time = None
             if self.camera_state in LED_state_switch:
                 LED = LED_state_switch[self.camera_state]
-                if (self.info_led_state % 4) == 0 and (round_cntr % 60) == 0:
+                if (self.info_led_state % 4) == 0:
                     self._led_power_heartbeat(LED)
-                elif (self.info_led_state % 4) == 1 and (round_cntr % 1) == 0:
+                    round_time = 60
+                elif (self.info_led_state % 4) == 1:
                     self._led_power_heartbeat(LED)
+                    round_time = 1
                 elif (self.info_led_state % 4) == 2:
                     if not LED_is_on:
                         LED.set_on()
@@ -240,24 +515,106 @@ class Dashcam():
                 else:
                     self.LED_info.set_off()
                     LED_is_on = False
-            #sleep to make catch changes in e.g. info led status changes
-            sleep(round_time)
-            round_cntr += round_time
+                round_time = 0.5
+            #wake up for the next animation step or any state change
+            subscription.get(round_time)
+
+    def _record_samples(self, sample_time, samples, period=0):
+        # samples oldest first; the last one was taken at sample_time
+        for idx, accl_xyz in enumerate(samples):
+            for sample_sink in self.sample_sinks:
+                sample_sink(sample_time - (len(samples) - 1 - idx) * period, *accl_xyz)
+
+    def _record_fusion_skew(self):
+        if isinstance(self.adxl345, FusedAdxl345):
+            self.metrics.set_gauge("g_force_fusion.max_skew_ms", self.adxl345.max_skew * 1000)
+
+    def _g_force_sample(self):
+        accl_xyz = self.adxl345.get_acceleration()
+        self._record_fusion_skew()
+        if self.sample_sinks:
+            self._record_samples(monotonic(), [accl_xyz])
+        if exceeds_limit(accl_xyz, self.g_force_limit):
+            self._request_incident(
+                source="g_force", peak_g=peak_g(accl_xyz),
+                sample_rate=self.g_force_sampler.achieved_rate()
+            )
 
-    def _g_force_surveillance(self):
-        for _ in range(5):
-            #cleanup at every start/coldstart (like at car ;) )
-            x,y,z = self.adxl345.get_acceleration()
-            sleep(1)
+    def _handle_sensor_interrupt(self):
+        with self.sensor_lock:
+            interrupt_time = monotonic()
+            source = self.adxl345.get_interrupt_source()
+            if not source & (Adxl345.INT_SINGLE_TAP | Adxl345.INT_ACTIVITY):
+                return
+            # the FIFO holds the samples around the event; only read it now
+            samples = self.adxl345.get_fifo_acceleration()
+        if self.sample_sinks:
+            self._record_samples(interrupt_time, samples, 1 / self.adxl345.data_rate)
+        if self.telemetry is not None:
+            # no more samples may follow for a long time
+            self.telemetry.flush()
+        samples_peak_g = max((peak_g(accl_xyz) for accl_xyz in samples), default=0)
+        self.metrics.increment("g_force_interrupts")
+        self._record_fusion_skew()
+        self.metrics.set_gauge(
+            "g_force_interrupt.read_ms", (monotonic() - interrupt_time) * 1000
+        )
+        # a shock is confirmed by the chip itself, whatever is left of it in
+        # the FIFO; activity is re-checked on the samples
+        is_shock = bool(source & Adxl345.INT_SINGLE_TAP)
+        if is_shock or samples_peak_g > self.g_force_limit:
+            self._request_incident(
+                source="g_force", peak_g=samples_peak_g, trigger="interrupt",
+                interrupt="single_tap" if is_shock else "activity",
+                samples=len(samples), trigger_time=interrupt_time
+            )
+
+    def _g_force_interrupt_functor(self, input):
+        if input == 1:
+            self._handle_sensor_interrupt()
+
+    def _arm_sensor_interrupts(self):
+        # a shock may span two samples at the lowered data rate
+        self.adxl345.set_interrupts(
+            self.g_force_limit, activity_g=self.g_force_limit,
+            shock_duration=2 / self.adxl345.data_rate
+        )
+
+    def _g_force_interrupt_surveillance(self):
+        subscription = self.bus.subscribe(events.STATE_CHANGED)
+        with self.sensor_lock:
+            self.adxl345.set_data_rate_level(SENSOR_INTERRUPT_DATA_RATE_LEVEL)
+            self.adxl345.set_fifo_mode(Adxl345.FIFO_MODE_STREAM)
+            self._arm_sensor_interrupts()
+        if self.SENSOR_int is None:
+            self.SENSOR_int = Switch(self.pin_sensor_int, edge_detector=1, pud=-1)
+        self.SENSOR_int.set_functor(self._g_force_interrupt_functor)
         while self.camera_state > 0:
-            accl_xyz = self.adxl345.get_acceleration()
-            if any(
-                fabs(val) > self.g_force_limit
-                for val in accl_xyz
-            ):
-                self.save_video_file_legal(self.LED_data)
-            sleep(0.5)
+            # rising edges are only seen if INT1 got low again; re-check now
+            # and then in case an interrupt was not cleared
+            if subscription.get(5) is None:
+                self._handle_sensor_interrupt()
+        subscription.close()
+        self.SENSOR_int.set_functor(lambda input: None)
+        with self.sensor_lock:
+            self.adxl345.disable_interrupts()
+            self.adxl345.set_fifo_mode(Adxl345.FIFO_MODE_BYPASS)
+        self.adxl345.stop()
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    def _g_force_surveillance(self):
+        if self.pin_sensor_int is not None:
+            self._g_force_interrupt_surveillance()
+            return
+        self.g_force_sampler = PeriodicSampler(
+            1 / self.g_force_sample_rate, self._g_force_sample,
+            priority=self.sampler_priority, metrics=self.metrics, name="g_force_sampler"
+        )
+        self.g_force_sampler.run(lambda: self.camera_state > 0)
         self.adxl345.stop()
+        if self.telemetry is not None:
+            self.telemetry.close()
 
     def get_directory_file_list(self, path, filetype):
         return [
@@ -270,6 +627,12 @@ class Dashcam():
         ]
 
     def get_video_file_list_legal(self, video_file_list, reverse=True, buffer=0):
+        # protected (recovered) files use up slots of the sequence count
+        protected_video_files = [
+            file
+            for file in self.protected_video_files
+            if file in video_file_list
+        ]
         prefix_match_sorted_reduced_video_fileid_list = sorted(
             [
                 file.removeprefix(
@@ -278,22 +641,69 @@ class Dashcam():
                     f'.{self.video_type}'
                 )
                 for file in video_file_list
-                if file.startswith(f"{self.video_name_prefix}_")
+                if (
+                    file.startswith(f"{self.video_name_prefix}_") and
+                    file not in protected_video_files
+                )
             ], key = (
                 lambda x: (
                     f"{int(x.split('-')[1] == self.video_name_salt)}{x}"
                 )
-            ), reverse=reverse
+            ), reverse=True
         )
 
-        return [
+        video_file_list_legal = protected_video_files + [
                 f"{self.video_name_prefix}_{fileid}.{self.video_type}"
                 for fileid in prefix_match_sorted_reduced_video_fileid_list
-            ][:self.video_sequence_count+buffer]
+            ][:self.video_sequence_count+buffer-len(protected_video_files)]
+        # always reduce to the newest files first, then apply the wished order
+        return video_file_list_legal if reverse else video_file_list_legal[::-1]
+
+    def _store_legal_file(self, video_file, entries):
+        src = f"{self.video_file_path}/{video_file}"
+        print(f"Store '{src}' for incident.")
+        # hashes from recording time are only valid for the untouched file
+        closed_entry = self.segment_digests.get(video_file)
+        digests = None
+        try:
+            if closed_entry is not None and closed_entry["size"] == os.path.getsize(src):
+                digests = closed_entry
+            digests, size, blob, is_new = self.incident_store.put(src, digests)
+        except FileNotFoundError:
+            print(f"WARNING! File '{src}' is gone. Ignoreing file. Continue")
+            return
+        if not is_new:
+            print(f"'{video_file}' is already stored for another incident.")
+        entries.append({
+            "name": f"INCIDENT_{video_file}", "file": video_file, "size": size,
+            "sha256": digests["sha256"], "chunks_sha256": digests["chunks_sha256"],
+            "blob": blob,
+        })
+
+    def _wait_segment_closed(self, subscription, video_file):
+        # a stalled recorder closes its segment once re-created; never wait
+        # longer than a segment plus that recovery
+        deadline = monotonic() + self.video_sequence_seconds + self.recovery_timeout
+        # the close may have been published before the subscription
+        while video_file not in self.segment_digests:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                print(
+                    f"WARNING! '{video_file}' was not closed in time. "
+                    "Storing it as it is. Continue"
+                )
+                return
+            event = subscription.wait_for(
+                lambda event: event.data["file"] == video_file, timeout=min(1, remaining)
+            )
+            if event is not None:
+                return
 
-    def save_video_file_legal(self, LED):
+    def save_video_file_legal(self, LED, **incident_info):
+        # LED is None if the GPIO is unavailable; saving goes on without it
         self.file_lock.acquire()
-        LED.set_on()
+        if LED is not None:
+            LED.set_on()
 
         video_file_list_legal = self.get_video_file_list_legal(
             self.get_directory_file_list(
@@ -301,74 +711,351 @@ class Dashcam():
             ), reverse=False
         )
 
-        timestamp = int(time())
-        legal_path = f"{self.video_file_path_legal}/{timestamp}_utc"
+        incident = incident_info.pop("incident", None) or self._new_incident_name()
+        legal_path = f"{self.video_file_path_legal}/{incident}"
         os.makedirs(legal_path, exist_ok=True)
 
+        # subscribe before reading the current filename, so its close is not missed
+        subscription = self.bus.subscribe(events.SEGMENT_CLOSED)
         current_video = self.video_filename
         is_active_saving = current_video in video_file_list_legal
         if is_active_saving:
             video_file_list_legal.remove(current_video)
 
+        # chunks are stored once in the blob store; the incident folder only
+        # references them, so overlapping incidents do not multiply storage
+        entries = []
         for video_file in video_file_list_legal:
-            src = f"{self.video_file_path}/{video_file}"
-            dst = f"{legal_path}/INCIDENT_{video_file}"
-            print(f"Copy '{src}' to '{dst}'.")
-            try:
-                shutil.copyfile(src, dst)
-            except FileNotFoundError:
-                print(f"WARNING! File '{src}' is gone. Ignoreing file. Continue")
-        while is_active_saving and self.video_filename == current_video:
+            self._store_legal_file(video_file, entries)
+        if is_active_saving:
             #waiting for current video to finish
-            sleep(5)
+            self._wait_segment_closed(subscription, current_video)
+        subscription.close()
         if is_active_saving:
-            src = f"{self.video_file_path}/{current_video}"
-            dst = f"{legal_path}/INCIDENT_{current_video}"
-            print(f"Copy '{src}' to '{dst}'.")
-            try:
-                shutil.copyfile(src, dst)
-            except FileNotFoundError:
-                print(f"WARNING! File '{src}' is gone. Ignoreing file. Continue")
+            self._store_legal_file(current_video, entries)
+        self._store_legal_stills(incident, entries)
+        self.incident_store.add_incident(legal_path, entries, **incident_info)
 
         print("Copy done.")
 
-        for round in range(int(self.pin_blink_seconds / self.pin_blink_on_seconds)):
-            if round % 2 == 0:
-                LED.set_on()
-            else:
-                LED.set_off()
-            sleep(self.pin_blink_on_seconds)
+        if LED is not None:
+            for round in range(int(self.pin_blink_seconds / self.pin_blink_on_seconds)):
+                if round % 2 == 0:
+                    LED.set_on()
+                else:
+                    LED.set_off()
+                sleep(self.pin_blink_on_seconds)
 
-        LED.set_off()
+            LED.set_off()
         self.file_lock.release()
 
+    def _open_incident_catalog(self):
+        # only an index of the manifests; a damaged one is re-created and
+        # must never keep incidents from being saved
+        path = os.path.join(self.video_file_path_legal, IncidentCatalog.FILENAME)
+        for attempt in range(2):
+            catalog = None
+            try:
+                catalog = IncidentCatalog(path)
+                if catalog.sync(self.incident_store):
+                    print("Incident catalog rebuilt from the manifests.")
+                return catalog
+            except sqlite3.Error as error:
+                print(f"WARNING! Incident catalog '{path}' unusable: {error}")
+                if catalog is not None:
+                    try:
+                        catalog.close()
+                    except sqlite3.Error:
+                        pass
+                if attempt == 0:
+                    print("Re-creating the incident catalog.")
+                    delete_catalog(path)
+        print("WARNING! Continuing without incident catalog. Continue")
+        return None
+
+    def _dashcam_incident_thread(self):
+        subscription = self.bus.subscribe(events.INCIDENT_REQUESTED)
+        # free chunks of incidents deleted (e.g. by hand) since the last run
+        self.file_lock.acquire()
+        self.incident_store.gc()
+        self.incident_store.catalog = self._open_incident_catalog()
+        self.file_lock.release()
+        last_save_end = 0
+        while True:
+            event = subscription.get()
+            # the sensor keeps on triggering during the same crash; these are
+            # already part of the incident saved meanwhile
+            if event.data.get("source") == "g_force" and event.time < last_save_end:
+                continue
+            print(f"Incident requested by {event.data.get('source', 'unknown')}.")
+            self.peripherals_ready.wait()
+            save_start = monotonic()
+            self.save_video_file_legal(self.LED_data, **event.data)
+            last_save_end = monotonic()
+            self.metrics.set_gauge("incident.save_ms", (last_save_end - save_start) * 1000)
+            self.upload_requested.set()
+
+    def _dashcam_upload_thread(self):
+        # the disk is shared with the recording: read at most twice as fast
+        # as the upload goes
+        uploader = Uploader(
+            self.video_file_path_legal, self.upload_endpoint,
+            bandwidth=self.upload_bandwidth,
+            read_rate=2 * self.upload_bandwidth if self.upload_bandwidth else None,
+            metrics=self.metrics
+        )
+        while True:
+            try:
+                upload_start = monotonic()
+                files, sent = uploader.run_once()
+                if sent:
+                    print(f"Uploaded {sent} bytes of {files} files.")
+                self.metrics.set_gauge("upload.last_run_s", monotonic() - upload_start)
+                self.metrics.set_gauge("upload.last_success", time())
+            except (OSError, ValueError) as error:
+                # e.g. not at home; try again later
+                self.metrics.increment("upload.failures")
+                print(f"WARNING! Upload to '{self.upload_endpoint}' failed: {error} Continue")
+            self.upload_requested.wait(self.upload_interval)
+            self.upload_requested.clear()
+
+    def _new_incident_name(self):
+        # several triggers (e.g. button and g-force, from different processes)
+        # may happen within the same second
+        return f"{int(time())}_utc-{randbytes(4).hex()}"
+
+    def _request_incident(self, **incident_info):
+        # named at the trigger moment, so stills and chunks of the incident
+        # end up in the same folder no matter which thread/process saves them
+        self.bus.publish(
+            events.INCIDENT_REQUESTED, incident=self._new_incident_name(), **incident_info
+        )
+
     def _button_copy_functor(self, input):
         if input == 0:
-            self.save_video_file_legal(self.LED_data)
+            self._request_incident(source="button")
+
+    def _queue_still(self, incident, index, buffer, trigger_time):
+        if index == 0:
+            self.metrics.set_gauge(
+                "stills.trigger_to_first_ms", (monotonic() - trigger_time) * 1000
+            )
+        self.still_queue.put((f"{incident}_still{index:02d}.jpg", buffer.getvalue()))
+
+    def _capture_still_burst(self, incident, event):
+        trigger_time = event.data.get("trigger_time", event.time)
+        buffers = []
+
+        def outputs():
+            for _ in range(self.still_count):
+                # the next output is only requested once the previous is complete
+                if buffers:
+                    self._queue_still(incident, len(buffers) - 1, buffers[-1], trigger_time)
+                buffers.append(BytesIO())
+                yield buffers[-1]
+
+        try:
+            # splitter port 0 records, 1 is the preview
+            self.camera.capture_sequence(
+                outputs(), format="jpeg", use_video_port=True, splitter_port=2,
+                quality=self.still_quality
+            )
+        except picamera.PiCameraError as error:
+            self.metrics.increment("stills.failed")
+            print(f"WARNING! Still burst failed: {error} Continue")
+            return
+        self._queue_still(incident, len(buffers) - 1, buffers[-1], trigger_time)
+        self.metrics.set_gauge("stills.burst_ms", (monotonic() - trigger_time) * 1000)
+        self.metrics.increment("stills.captured", len(buffers))
+
+    def _dashcam_still_thread(self):
+        subscription = self.bus.subscribe(events.INCIDENT_REQUESTED)
+        last_burst_end = 0
+        while True:
+            event = subscription.get()
+            incident = event.data.get("incident") or self._new_incident_name()
+            is_repeated = (
+                event.data.get("source") == "g_force" and event.time < last_burst_end
+            )
+            if not is_repeated and self.camera_state == 2 and self.still_count > 0:
+                self._capture_still_burst(incident, event)
+                last_burst_end = monotonic()
+            # tells the incident handling that all stills of it are written
+            self.still_queue.put((incident, None))
+
+    def _dashcam_still_writer_thread(self):
+        # JPEG encoding is done by the GPU; only the writing is left to do
+        # here, away from the capture
+        while True:
+            name, data = self.still_queue.get()
+            if data is None:
+                self.bus.publish(events.STILLS_WRITTEN, incident=name)
+                continue
+            path = f"{self.still_path}/{name}"
+            with open(f"{path}.tmp", "wb") as file:
+                file.write(data)
+            os.replace(f"{path}.tmp", path)
+
+    def _start_still_threads(self):
+        with self.still_lock:
+            if self.still_threads_started:
+                return
+            self.still_threads_started = True
+        os.makedirs(self.still_path, exist_ok=True)
+        Thread(target=self._dashcam_still_thread, daemon=True).start()
+        Thread(target=self._dashcam_still_writer_thread, daemon=True).start()
+
+    def _store_legal_stills(self, incident, entries):
+        if self.still_count > 0:
+            # the burst is taken at the trigger, but may still be written
+            written = self.stills_subscription.wait_for(
+                lambda event: event.data["incident"] == incident, timeout=STILL_BURST_TIMEOUT
+            )
+            if written is None:
+                print(f"WARNING! Stills of '{incident}' not written in time. Continue")
+        try:
+            stills = sorted(
+                name
+                for name in os.listdir(self.still_path)
+                if name.startswith(f"{incident}_still") and name.endswith(".jpg")
+            )
+        except FileNotFoundError:
+            return
+        for still in stills:
+            src = f"{self.still_path}/{still}"
+            digests, size, blob, _ = self.incident_store.put(src)
+            os.remove(src)
+            entries.append({
+                "name": still, "file": still, "size": size,
+                "sha256": digests["sha256"], "chunks_sha256": digests["chunks_sha256"],
+                "blob": blob,
+            })
+
+    def reload_config(self):
+        """
+        Re-read the config file and apply what can be changed while running;
+        changes of other arguments are reported, as they need a restart.
+        """
+        if self.config_path is None:
+            print("WARNING! No config file to reload. Continue")
+            return
+        try:
+            values, unknown = read_config(self.config_path, self.init_kwargs)
+        except (OSError, ValueError) as error:
+            print(f"WARNING! Config not reloaded: {error} Continue")
+            return
+        for key in unknown:
+            print(f"WARNING! Unknown config key '{key}'. Ignoring key. Continue")
+        changed = {
+            key: value
+            for key, value in values.items()
+            if value != self.init_kwargs[key]
+        }
+        restart_required = sorted(key for key in changed if key not in HOT_RELOADABLE)
+        for key in restart_required:
+            print(f"WARNING! '{key}' needs a restart of the dashcam. Not applied. Continue")
+        self.metrics.set_gauge("config.restart_required", restart_required)
+        hot_values = {
+            key: value
+            for key, value in changed.items()
+            if key in HOT_RELOADABLE
+        }
+        self.init_kwargs.update(hot_values)
+        print(f"Config reloaded; applying {hot_values or 'no changes'}.")
+        # every process applies it to its own components
+        self.bus.publish(events.CONFIG_CHANGED, values=hot_values)
+
+    def _apply_config(self, values):
+        for key, value in values.items():
+            setattr(self, HOT_RELOADABLE[key], value)
+        if "g_force_limit" in values and self.pin_sensor_int is not None:
+            # the sensor compares on its own; arm it with the new limit
+            if self.adxl345 is not None and "sensor" in self.components:
+                with self.sensor_lock:
+                    self._arm_sensor_interrupts()
+        if self.still_count > 0 and "recorder" in self.components:
+            self._start_still_threads()
+        if "led_pwr_dim_perc" in values and self.camera_state == 2:
+            if self.LED_power is not None:
+                self.LED_power.set_duty_cycle(self.pin_led_pwr_dim_percent)
+        self.metrics.increment("config.reloads")
+
+    def _dashcam_config_thread(self):
+        subscription = self.bus.subscribe(events.CONFIG_CHANGED)
+        while True:
+            event = subscription.get()
+            self._apply_config(event.data["values"])
+
+    def _dashcam_control_thread(self):
+        # executes start/stop requests of the buttons of another process
+        subscription = self.bus.subscribe(events.CONTROL_REQUESTED)
+        while True:
+            event = subscription.get()
+            if event.data["command"] == "start":
+                self._button_start_functor(0)
+            elif event.data["command"] == "stop":
+                self._button_stop_functor(0)
+
+    def _dashcam_state_mirror_thread(self, subscription):
+        # processes without the recorder learn its state from its events
+        while True:
+            event = subscription.get()
+            if event.type == events.SEGMENT_STARTED:
+                self.video_filename = event.data["file"]
+            elif event.type == events.SEGMENT_CLOSED:
+                if "incident" in self.components:
+                    self.segment_digests[event.data["file"]] = event.data
+            elif event.data["key"] == "camera_state":
+                self.camera_state = event.data["value"]
+                if self.camera_state == 2 and "sensor" in self.components:
+                    self.camera_lock.acquire()
+                    if self.peripherals_ready.is_set():
+                        self._start_surveillance()
+                    self.camera_lock.release()
+
+    def _start_recording(self):
+        self._set_camera_state(2)
+        self.video_thread = Thread(target=self._dashcam_video_thread)
+        self.video_thread.start()
+
+    def _start_surveillance(self):
+        if self.LED_power is not None:
+            self.LED_power.set_duty_cycle(self.pin_led_pwr_dim_percent)
+        if self.adxl345 is not None and "sensor" in self.components:
+            if hasattr(self, "g_force_thread") and self.g_force_thread.is_alive():
+                return
+            self.g_force_thread = Thread(target=self._g_force_surveillance)
+            self.g_force_thread.start()
 
     def _button_start_functor(self, input):
         if input == 0:
+            if "recorder" not in self.components:
+                self.bus.publish(events.CONTROL_REQUESTED, command="start")
+                return
             if self.camera_state == 0:
                 self.camera_lock.acquire()
-                self.camera_state = 2
-                self.video_thread = Thread(target=self._dashcam_video_thread)
-                self.g_force_thread = Thread(target=self._g_force_surveillance)
-                self.video_thread.start()
-                self.LED_power.set_duty_cycle(self.pin_led_pwr_dim_percent)
-                self.g_force_thread.start()
-                sleep(10) #mainly user notification via LED on
+                if self.camera_state == 0:
+                    self._start_recording()
+                    self._start_surveillance()
                 self.camera_lock.release()
 
     def _button_stop_functor(self, input):
         if input == 0:
+            if "recorder" not in self.components:
+                self.bus.publish(events.CONTROL_REQUESTED, command="stop")
+                if self.LED_power is not None:
+                    self.LED_power.set_off()
+                return
             if self.camera_state == 2:
                 self.camera_lock.acquire()
-                self.camera_state = 1
-                self.LED_power.set_off()
+                self._set_camera_state(1)
+                if self.LED_power is not None:
+                    self.LED_power.set_off()
                 self.video_thread.join()
-                self.g_force_thread.join()
+                if hasattr(self, "g_force_thread"):
+                    self.g_force_thread.join()
+                    del self.g_force_thread
                 del self.video_thread
-                del self.g_force_thread
                 self.camera_lock.release()
 
     def _button_info_functor(self, input):
@@ -376,10 +1063,16 @@ class Dashcam():
             # in order to keep numbers small and as we probably won't
             # have more than 100 blinking states, lets keep it 0 < x < 100 !
             self.info_led_state = (self.info_led_state + 1) % 100
+            self.bus.publish(
+                events.STATE_CHANGED, key="info_led_state", value=self.info_led_state
+            )
 
     def do_warning(self):
         # just blink at info LED!
         # can be used when e.g. mountpoint is unavailable!!!
+        self.peripherals_ready.wait()
+        if self.LED_info is None:
+            return
         for _ in range(10):
             self.LED_info.set_on()
             sleep(0.5)
@@ -387,26 +1080,300 @@ class Dashcam():
             sleep(0.5)
 
 
-    def start(self):
-        os.makedirs(self.video_file_path, exist_ok=True)
-        os.makedirs(self.video_file_path_legal, exist_ok=True)
+    def _close_camera(self, camera):
+        # closing a stalled camera may block as well; never wait forever
+        def close():
+            try:
+                camera.close()
+            except Exception as error:
+                print(f"WARNING! Closing the stalled camera failed: {error}")
+        close_thread = Thread(target=close, daemon=True)
+        close_thread.start()
+        close_thread.join(self.recovery_timeout / 2)
+        return not close_thread.is_alive()
+
+    def _recover_camera(self, reason):
+        """
+        Tear down and re-create the camera and restart recording in-process.
+        Returns: True if a new segment receives data within recovery_timeout
+        """
+        print(f"WARNING! Recorder stalled ({reason}). Re-creating camera.")
+        recovery_start = monotonic()
+        self.metrics.set_gauge("recorder.last_stall_reason", reason)
+        with self.camera_lock:
+            if self.camera_state != 2:
+                return True
+            self.recorder_generation += 1
+            stalled_segment = self.current_segment
+            if not self._close_camera(self.camera):
+                print("WARNING! Stalled camera did not close in time. Continue")
+            if stalled_segment is not None:
+                self._close_segment(stalled_segment)
+            try:
+                self._init_camera()
+            except picamera.PiCameraError as error:
+                print(f"WARNING! Re-creating camera failed: {error}")
+                self.metrics.increment("recorder.failed_recoveries")
+                return False
+            if self.preview_server is not None:
+                self.preview_server.set_camera(self.camera)
+            self.segment_ctr += 1
+            self._start_recording()
+        # recovered once encoded data arrives again
+        deadline = recovery_start + self.recovery_timeout
+        while monotonic() < deadline:
+            segment = self.current_segment
+            if segment is not None and segment is not stalled_segment and segment.bytes_written:
+                recovery_ms = (monotonic() - recovery_start) * 1000
+                self.metrics.increment("recorder.recoveries")
+                self.metrics.set_gauge("recorder.recovery_ms", recovery_ms)
+                print(f"Recorder recovered after {recovery_ms:.0f}ms.")
+                return True
+            sleep(0.05)
+        self.metrics.increment("recorder.failed_recoveries")
+        return False
+
+    def _dashcam_watchdog_thread(self):
+        period = watchdog_period()
+        self.watchdog.reset(monotonic())
+        while True:
+            sleep(period)
+            if self.camera_state == 0:
+                # nothing to watch while stopped; the process is alive though
+                self.watchdog.reset(monotonic())
+                sd_notify("WATCHDOG=1")
+                continue
+            # while turning down (1), the last segment is still recorded and
+            # stop_recording() must finish as well
+            segment = self.current_segment
+            video_thread = getattr(self, "video_thread", None)
+            reason = self.watchdog.check(
+                monotonic(), video_thread is not None and video_thread.is_alive(),
+                (segment.filename, segment.bytes_written) if segment is not None else None,
+                self.last_split_time, self.current_segment_seconds
+            )
+            if reason is None:
+                sd_notify("WATCHDOG=1")
+                continue
+            if self.camera_state == 1:
+                # nothing to recover, it is being stopped; let systemd restart
+                print(f"WARNING! Recorder stalled while stopping ({reason}).")
+            elif self._recover_camera(reason):
+                self.watchdog.reset(monotonic())
+                sd_notify("WATCHDOG=1")
+            else:
+                # no more keep-alives: systemd restarts the service once
+                # WatchdogSec passed
+                print("WARNING! Recorder recovery failed. Retrying.")
 
-        self.power_led_thread = Thread(target=self._dashcam_powerled_thread)
-        self.clean_thread = Thread(target=self._dashcam_file_cleanup_thread)
+    def _check_still_resolution(self, revision=None):
+        """
+        Returns: None if the camera can run at the still resolution for the
+                 recording, else the reason why not
+        """
+        still_width, still_height = self.still_resolution
+        video_width, video_height = self.video_resolution
+        # the recording is scaled from it; another aspect ratio squeezes it
+        aspect_error = abs(still_width * video_height - still_height * video_width)
+        if aspect_error > 0.01 * still_width * video_height:
+            return f"aspect ratio differs from the video resolution {video_width}x{video_height}"
+        if revision not in SENSOR_FULL_MODES:
+            return None
+        (full_width, full_height), max_framerate = SENSOR_FULL_MODES[revision]
+        # beyond the binned modes only the slow full resolution mode is left
+        needs_full_mode = still_width > full_width // 2 or still_height > full_height // 2
+        if needs_full_mode and self.video_frame_rate > max_framerate:
+            return (
+                f"the full resolution mode of the {revision} sensor runs at most "
+                f"{max_framerate} fps, not {self.video_frame_rate}"
+            )
+        return None
 
-        self.BTN_data.set_functor(self._button_copy_functor)
-        self.BTN_power.set_functor(self._button_start_functor)
-        self.BTN_stop.set_functor(self._button_stop_functor)
-        self.BTN_info.set_functor(self._button_info_functor)
+    def _reject_still_resolution(self, reason):
+        print(
+            f"WARNING! Still resolution {self.still_resolution[0]}x{self.still_resolution[1]} "
+            f"not used: {reason}. Stills are taken at the video resolution. Continue"
+        )
+        self.still_resolution = None
 
-        self.power_led_thread.start()
-        self.clean_thread.start()
+    def _init_camera(self):
+        if self.still_resolution:
+            reason = self._check_still_resolution()
+            if reason is not None:
+                self._reject_still_resolution(reason)
+        self.camera = picamera.PiCamera(
+            resolution=self.still_resolution or self.video_resolution,
+            framerate=self.video_frame_rate
+        )
+        if self.still_resolution:
+            # the sensor is only known once the camera is open
+            reason = self._check_still_resolution(self.camera.revision)
+            if reason is not None:
+                self._reject_still_resolution(reason)
+                self.camera.resolution = self.video_resolution
+        self._mark_startup("camera_open")
+
+    def _init_gpio(self):
+        # recording and incident saving go on without LEDs and buttons; what
+        # could not be set up stays None
+        try:
+            if "incident" in self.components:
+                self.LED_data = LED(self.pin_led_cpy)
+            if "ui" not in self.components:
+                return
+            self.LED_power = LED(self.pin_led_pwr)
+            self.LED_info = LED(self.pin_led_info)
+
+            self.BTN_data = Switch(self.pin_btn_cpy)
+            self.BTN_power = Switch(self.pin_btn_pwr)
+            self.BTN_stop = Switch(self.pin_btn_stop)
+            self.BTN_info = Switch(self.pin_btn_info)
+        except Exception as error:
+            self.metrics.increment("gpio.failures")
+            print(f"WARNING! GPIO (LEDs, buttons) unavailable: {error} Continue")
+
+    def _init_sensor(self):
+        try:
+            if self.sensor_bus == "i2c":
+                adxl345 = Adxl345I2C(self.sensor_i2c_bus, self.sensor_i2c_address)
+            elif len(self.sensor_spi_channels) > 1:
+                adxl345 = FusedAdxl345(
+                    [Adxl345Spi(channel) for channel in self.sensor_spi_channels],
+                    fusion=self.sensor_fusion
+                )
+            else:
+                adxl345 = Adxl345Spi(self.sensor_spi_channels[0])
+            adxl345.set_on()
+            #cleanup at every start/coldstart (like at car ;) ), but only
+            #for a few samples at the sensors data rate instead of seconds
+            for _ in range(5):
+                adxl345.get_acceleration()
+                sleep(1 / adxl345.data_rate)
+        except Exception as error:
+            print(f"WARNING! Acceleration sensor unavailable: {error}")
+            return
+        if self.telemetry_path is not None:
+            # one trace per session, to replay with detection.py
+            self.telemetry = TelemetryWriter(
+                f"{self.telemetry_path}/{self.video_name_salt}.bin"
+            )
+            self.sample_sinks.append(self.telemetry.write)
+        self.adxl345 = adxl345
+
+    def _init_peripherals(self):
+        # GPIO (LEDs, buttons) and the pigpio based sensor are independent
+        init_threads = [Thread(target=self._init_gpio)]
+        if "sensor" in self.components:
+            init_threads.append(Thread(target=self._init_sensor))
+        for init_thread in init_threads:
+            init_thread.start()
+        for init_thread in init_threads:
+            init_thread.join()
+        self._mark_startup("peripherals_ready")
+
+        if "ui" in self.components:
+            if self.LED_power is not None and self.LED_info is not None:
+                self.power_led_thread = Thread(target=self._dashcam_powerled_thread)
+                self.power_led_thread.start()
+
+            for button, functor in (
+                    (self.BTN_data, self._button_copy_functor),
+                    (self.BTN_power, self._button_start_functor),
+                    (self.BTN_stop, self._button_stop_functor),
+                    (self.BTN_info, self._button_info_functor)):
+                if button is not None:
+                    button.set_functor(functor)
+
+        # recording might have been started before or after this point;
+        # whoever comes second starts the surveillance
+        self.camera_lock.acquire()
+        self.peripherals_ready.set()
+        if self.camera_state == 2:
+            self._start_surveillance()
+        self.camera_lock.release()
+
+    def start(self, components=COMPONENTS):
+        os.makedirs(self.video_file_path, exist_ok=True)
+        os.makedirs(self.video_file_path_legal, exist_ok=True)
 
-        self._button_start_functor(0)
+        if self.isolation == "process" and self.process_role is None:
+            # this process only keeps buttons and LEDs and supervises the rest
+            components = ("ui",)
+            self.supervisor = ProcessSupervisor(self, self.init_kwargs)
+        self.components = set(components)
+
+        self.segment_index = SegmentIndex(
+            os.path.join(self.video_file_path, SegmentIndex.FILENAME)
+        )
+        metrics_name = (
+            "metrics.json" if self.process_role is None
+            else f"metrics-{self.process_role}.json"
+        )
+        self.metrics.subscribe_to(self.bus, os.path.join(self.video_file_path, metrics_name))
+        if "recorder" not in self.components:
+            # subscribed here, so no state relayed meanwhile gets lost
+            subscription = self.bus.subscribe(
+                events.STATE_CHANGED, events.SEGMENT_STARTED, events.SEGMENT_CLOSED
+            )
+            Thread(
+                target=self._dashcam_state_mirror_thread, args=(subscription,), daemon=True
+            ).start()
+        if self.supervisor is not None:
+            self.supervisor.start()
+        Thread(target=self._dashcam_config_thread, daemon=True).start()
+
+        if "incident" in self.components:
+            # the catalog is opened by the incident thread, not on the way
+            # to the first frame
+            self.incident_store = IncidentStore(
+                self.video_file_path_legal, self.manifest_key_path
+            )
+            # before any burst might be written
+            self.stills_subscription = self.bus.subscribe(events.STILLS_WRITTEN)
+            self.incident_thread = Thread(target=self._dashcam_incident_thread)
+            self.incident_thread.start()
+            if self.upload_endpoint is not None:
+                Thread(target=self._dashcam_upload_thread, daemon=True).start()
+
+        # peripherals are initialised while the camera is opened; recording
+        # itself does not wait for any of them
+        self.peripheral_thread = Thread(target=self._init_peripherals)
+        self.peripheral_thread.start()
+
+        if "recorder" in self.components:
+            if self.process_role is not None:
+                Thread(target=self._dashcam_control_thread, daemon=True).start()
+            self._init_camera()
+            if self.still_count > 0:
+                self._start_still_threads()
+            self.camera_lock.acquire()
+            self._start_recording()
+            if self.peripherals_ready.is_set():
+                self._start_surveillance()
+            self.camera_lock.release()
+            sd_notify("READY=1")
+            Thread(target=self._dashcam_watchdog_thread, daemon=True).start()
+
+        if "incident" in self.components:
+            self.clean_thread = Thread(target=self._dashcam_file_cleanup_thread)
+            self.clean_thread.start()
+
+        if self.preview_port is not None and "recorder" in self.components:
+            self.preview_server = PreviewServer(
+                self.camera, port=self.preview_port, video_type=self.preview_format,
+                resolution=self.preview_resolution
+            )
+            self.preview_server.start()
 
     def join_clean_thread(self):
         self.clean_thread.join()
 
+    def join(self):
+        if self.supervisor is not None:
+            self.supervisor.join()
+        else:
+            self.join_clean_thread()
+
 def main():
     parser = argparse.ArgumentParser(
         description="""DashCam-app following the German traffic and GDPR (DSGVO)
@@ -452,6 +1419,10 @@ def main():
         "-r", "--video_resolution", metavar="R", nargs=2, type=int, required=False,
         default=(1920, 1080), help="Length of a single stored video chunk."
     )
+    parser.add_argument(
+        "-fr", "--video_framerate", metavar="FR", type=int, required=False,
+        default=30, help="Framerate used to record videos."
+    )
     parser.add_argument(
         "-br", "--video_bitrate", metavar="BR", type=int, required=False,
         default=7000000, help="Bitrate used to store videos."
@@ -496,6 +1467,154 @@ def main():
         "-g", "--g_force_limit", metavar="G", type=int, required=False, default=1.5,
         help="Threshold in terms of g-Force, when a data copy should be triggered."
     )
+    parser.add_argument(
+        "--preview_port", metavar="PORT", type=int, required=False, default=None,
+        help=(
+            "Enable the live-preview HTTP server on the given port, e.g. to align "
+            "the camera on its mount. Disabled by default."
+        )
+    )
+    parser.add_argument(
+        "--preview_format", metavar="PF", type=str, required=False,
+        default="mjpeg", choices=("h264","mjpeg"), help="Stream format of the live preview."
+    )
+    parser.add_argument(
+        "--preview_resolution", metavar="PR", nargs=2, type=int, required=False,
+        default=(640, 360), help="Resolution of the live preview stream."
+    )
+    parser.add_argument(
+        "--recovery_segment_count", metavar="RC", type=int, required=False, default=1,
+        help=(
+            "Number of last video chunks of the previous (e.g. power cut) session "
+            "to repair and keep within the chunk count; 0 disables recovery."
+        )
+    )
+    parser.add_argument(
+        "--sensor_bus", metavar="BUS", type=str, required=False, default="spi",
+        choices=("spi", "i2c"), help="Bus the ADXL345 acceleration sensor is attached to."
+    )
+    parser.add_argument(
+        "--sensor_spi_channels", metavar="C", type=int, nargs="+", required=False,
+        default=[0], help=(
+            "SPI channels (chip selects) of the acceleration sensors, e.g. 0 1 for "
+            "a second sensor elsewhere in the car; several sensors share one "
+            "pigpio connection and are fused into one reading (default: 0)."
+        )
+    )
+    parser.add_argument(
+        "--sensor_fusion", metavar="F", type=str, required=False, default="agree",
+        choices=FusedAdxl345.FUSIONS, help=(
+            "How readings of several sensors are combined: 'agree' keeps the "
+            "smallest magnitude per axis (rejects vibrations only one sensor "
+            "sees), 'mean' averages (default: agree)."
+        )
+    )
+    parser.add_argument(
+        "--sensor_i2c_bus", metavar="I2CBUS", type=int, required=False, default=1,
+        help="I2C bus number of the acceleration sensor, if attached via I2C."
+    )
+    parser.add_argument(
+        "--sensor_i2c_address", metavar="I2CADDR", type=lambda x: int(x, 0),
+        required=False, default=Adxl345I2C.ADDR_I2C_DEFAULT,
+        help="I2C address of the acceleration sensor, e.g. 0x53 or 0x1D."
+    )
+    parser.add_argument(
+        "--g_force_sample_rate", metavar="HZ", type=float, required=False, default=2,
+        help="Rate in Hz in which the acceleration sensor is read for the g-Force check."
+    )
+    parser.add_argument(
+        "--sampler_priority", metavar="PRIO", type=int, required=False, default=None,
+        help=(
+            "Optional SCHED_FIFO priority (1-99) of the sensor sampling thread; "
+            "needs root. Not elevated by default."
+        )
+    )
+    parser.add_argument(
+        "-ps", "--pin_sensor_int", metavar="PSI", type=int, required=False, default=None,
+        help=(
+            "Pin number in GPIO.BOARD layout connected to INT1 of the acceleration "
+            "sensor. If set, the sensor detects shocks itself and is only read on "
+            "interrupt instead of being polled."
+        )
+    )
+    parser.add_argument(
+        "--manifest_key_path", metavar="K", type=str, required=False,
+        default="/opt/dashcam/.manifest.key", help=(
+            "Device key to sign incident manifests with; created if missing. "
+            "Should not be on the (external) video storage."
+        )
+    )
+    parser.add_argument(
+        "--isolation", metavar="I", type=str, required=False, default="thread",
+        choices=("thread", "process"), help=(
+            "'process' runs recorder, sensor and incident handling in separate "
+            "processes (no shared GIL); 'thread' runs everything in one process."
+        )
+    )
+    parser.add_argument(
+        "--upload_endpoint", metavar="URL", type=str, required=False, default=None,
+        help=(
+            "Base URL of a sync endpoint (e.g. http://nas.local:8080/dashcam) the "
+            "incidents are uploaded to whenever it is reachable; see upload.py."
+        )
+    )
+    parser.add_argument(
+        "--upload_bandwidth", metavar="B", type=int, required=False, default=None,
+        help="Upload limit in bytes per second (default: unlimited)."
+    )
+    parser.add_argument(
+        "--upload_interval", metavar="S", type=int, required=False, default=300,
+        help="Seconds between upload attempts (default: 300)."
+    )
+    parser.add_argument(
+        "--still_count", metavar="N", type=int, required=False, default=5,
+        help="Number of JPEG stills taken at every incident (0: none, default: 5)."
+    )
+    parser.add_argument(
+        "--still_resolution", metavar="R", type=int, nargs=2, required=False,
+        default=None, help=(
+            "Resolution of the stills, e.g. 3280 1845 for the full sensor width "
+            "of the camera V2; the camera then runs at it and the video is scaled "
+            "down. Needs the aspect ratio of the video resolution and a framerate "
+            "the sensor mode supports (full resolution modes: at most 15 fps, "
+            "e.g. --video_framerate 15); ignored otherwise."
+        )
+    )
+    parser.add_argument(
+        "--still_quality", metavar="Q", type=int, required=False, default=90,
+        help="JPEG quality of the stills (1..100, default: 90)."
+    )
+    parser.add_argument(
+        "--telemetry_path", metavar="P", type=str, required=False, default=None,
+        help=(
+            "Folder to record all acceleration samples into (one file per session); "
+            "replay them with detection.py to tune the g-force limit."
+        )
+    )
+    parser.add_argument(
+        "--config", metavar="FILE", type=str, required=False, default=None,
+        help=(
+            "INI file with a [dashcam] section of Dashcam arguments (e.g. "
+            "sequence_length = 30) overriding the command line. Re-read on "
+            "SIGHUP: chunk length/count, g_force_limit, led_pwr_dim_perc and the "
+            "still/upload settings are applied while running, other changes are "
+            "reported as needing a restart."
+        )
+    )
+    parser.add_argument(
+        "--stall_timeout", metavar="S", type=float, required=False, default=5,
+        help=(
+            "Seconds without encoded video data after which the camera is "
+            "re-created (default: 5)."
+        )
+    )
+    parser.add_argument(
+        "--recovery_timeout", metavar="S", type=float, required=False, default=20,
+        help=(
+            "Seconds a camera re-creation may take; keep below WatchdogSec of "
+            "the service, which restarts the dashcam otherwise (default: 20)."
+        )
+    )
     parser.add_argument(
         "--external_usb_storage_device", metavar="DEVICE", type=str, required=False,
         help=(
@@ -512,6 +1631,7 @@ def main():
     video_file_prefix = args.video_file_prefix
     video_resolution = args.video_resolution
     video_bitrate = args.video_bitrate
+    video_framerate = args.video_framerate
     video_format = args.video_format
     pin_button_copy = args.pin_button_copy
     pin_button_power = args.pin_button_power
@@ -522,30 +1642,89 @@ def main():
     pin_led_info = args.pin_led_info
     pin_power_dim_percent = args.pin_power_dim_percent
     g_force_limit = args.g_force_limit
+    preview_port = args.preview_port
+    preview_format = args.preview_format
+    preview_resolution = args.preview_resolution
+    recovery_segment_count = args.recovery_segment_count
+    sensor_bus = args.sensor_bus
+    sensor_i2c_bus = args.sensor_i2c_bus
+    sensor_i2c_address = args.sensor_i2c_address
+    g_force_sample_rate = args.g_force_sample_rate
+    sampler_priority = args.sampler_priority
+    pin_sensor_int = args.pin_sensor_int
+    manifest_key_path = args.manifest_key_path
+    isolation = args.isolation
+    upload_endpoint = args.upload_endpoint
+    upload_bandwidth = args.upload_bandwidth
+    upload_interval = args.upload_interval
+    still_count = args.still_count
+    still_resolution = args.still_resolution
+    still_quality = args.still_quality
+    telemetry_path = args.telemetry_path
+    config_path = args.config
+    stall_timeout = args.stall_timeout
+    sensor_spi_channels = args.sensor_spi_channels
+    sensor_fusion = args.sensor_fusion
+    recovery_timeout = args.recovery_timeout
     usb_storage = args.external_usb_storage_device if hasattr(args,'external_usb_storage_device') else None
 
 
     dashcam = Dashcam(
         sequence_count=video_chunk_count, sequence_length=video_chunk_duration,
         resolution=video_resolution, video_type=video_format, bitrate=video_bitrate,
+        framerate=video_framerate,
         video_name_prefix=video_file_prefix, video_file_path=video_file_path,
         pin_btn_cpy=pin_button_copy, pin_btn_pwr=pin_button_power,
         pin_btn_info=pin_button_info, pin_btn_stop=pin_button_stop,
         pin_led_cpy=pin_led_copy, pin_led_pwr=pin_led_power, pin_led_info=pin_led_info,
-        led_pwr_dim_perc=pin_power_dim_percent, g_force_limit=g_force_limit
+        led_pwr_dim_perc=pin_power_dim_percent, g_force_limit=g_force_limit,
+        preview_port=preview_port, preview_format=preview_format,
+        preview_resolution=preview_resolution,
+        recovery_segment_count=recovery_segment_count, sensor_bus=sensor_bus,
+        sensor_i2c_bus=sensor_i2c_bus, sensor_i2c_address=sensor_i2c_address,
+        g_force_sample_rate=g_force_sample_rate, sampler_priority=sampler_priority,
+        pin_sensor_int=pin_sensor_int, manifest_key_path=manifest_key_path,
+        isolation=isolation, upload_endpoint=upload_endpoint,
+        upload_bandwidth=upload_bandwidth, upload_interval=upload_interval,
+        still_count=still_count, still_resolution=still_resolution,
+        still_quality=still_quality, telemetry_path=telemetry_path,
+        stall_timeout=stall_timeout, recovery_timeout=recovery_timeout,
+        sensor_spi_channels=sensor_spi_channels, sensor_fusion=sensor_fusion
+    )
+    if config_path is not None:
+        # the config file takes precedence over the command line
+        try:
+            config_values, unknown = read_config(config_path, dashcam.init_kwargs)
+        except (OSError, ValueError) as error:
+            print(f"WARNING! Config not read: {error} Using the command line. Continue")
+            config_values, unknown = {}, []
+        for key in unknown:
+            print(f"WARNING! Unknown config key '{key}'. Ignoring key. Continue")
+        dashcam = Dashcam(**{**dashcam.init_kwargs, **config_values}, isolation=isolation)
+        dashcam.config_path = config_path
+    # always handled: the default action of SIGHUP (e.g. systemctl reload)
+    # would end the recording; not within the handler, as it may interrupt
+    # a thread holding a lock
+    signal.signal(
+        signal.SIGHUP,
+        lambda signum, frame: Thread(target=dashcam.reload_config).start()
     )
 
 
+    usb_warning = False
     if usb_storage is not None:
         usb_device = get_usb_storage_device(usb_storage)
         if usb_device is not None:
             mount_path = mount_usb_device(f"/dev/{usb_device}", "dashcam-videodata")
             dashcam.set_video_path(mount_path)
         else:
-            dashcam.do_warning()
+            usb_warning = True
 
     dashcam.start()
-    dashcam.join_clean_thread()
+    if usb_warning:
+        # do not delay recording for the warning blinks
+        Thread(target=dashcam.do_warning).start()
+    dashcam.join()
 
 
 if __name__=='__main__':
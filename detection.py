@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+"""
+This module holds the crash detection of the dashcam and the tooling to tune
+it offline: recorded accelerometer traces (CSV or the binary telemetry the
+dashcam writes) are replayed through the same detection, and a grid of
+g-force limits and sample rates is evaluated against labelled crash windows
+in one batch, reporting precision, recall and trigger latency per setting.
+The batch evaluation uses numpy if available and falls back to plain Python
+(bisect) otherwise.
+Can also be used as stand-alone script to run such a sweep.
+Classes:
+    Trace
+    TelemetryWriter
+Functions:
+    peak_g
+    exceeds_limit
+    read_trace
+    replay_trace
+    evaluate_grid
+    main
+"""
+import os
+import csv
+import struct
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import accumulate
+from math import fabs
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# monotonic time, x, y, z in g; the format of the telemetry and sample rings
+SAMPLE_FORMAT = "<dddd"
+
+
+def peak_g(accl_xyz):
+    return max(fabs(val) for val in accl_xyz)
+
+
+def exceeds_limit(accl_xyz, g_force_limit):
+    """
+    The crash criterion: any axis beyond the g-force limit.
+    """
+    return peak_g(accl_xyz) > g_force_limit
+
+
+class Trace():
+    """
+    Accelerometer trace with optional labelled crash windows.
+    Keyword Arguments:
+        name -- name shown in reports
+        times -- sample times in seconds, ascending
+        peaks -- peak_g() of every sample
+        labels -- list of (start, end) crash windows in the same time base;
+                  overlapping windows are merged into one crash
+    """
+    def __init__(self, name, times, peaks, labels=()):
+        self.name = name
+        self.times = times
+        self.peaks = peaks
+        self.labels = []
+        for start, end in sorted(labels):
+            if self.labels and start <= self.labels[-1][1]:
+                self.labels[-1] = (self.labels[-1][0], max(self.labels[-1][1], end))
+            else:
+                self.labels.append((start, end))
+
+    def sample_rate(self):
+        if len(self.times) < 2 or self.times[-1] <= self.times[0]:
+            return 0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class TelemetryWriter():
+    """
+    Sample sink appending the sensor samples to a binary telemetry file
+    (SAMPLE_FORMAT records) that read_trace() can replay later on. Samples
+    are flushed once per flush_interval of sample time; after close() the
+    next sample opens the file again.
+    Keyword Arguments:
+        path -- file to append to
+        flush_interval -- seconds of samples kept in the buffer at most (default: 1)
+    """
+    def __init__(self, path, flush_interval=1):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.flush_interval = flush_interval
+        self.record = struct.Struct(SAMPLE_FORMAT)
+        # the sampler and interrupt threads write, the surveillance closes
+        self.lock = Lock()
+        self.file = None
+        self.flush_time = None
+
+    def write(self, sample_time, x, y, z):
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+                self.flush_time = sample_time
+            self.file.write(self.record.pack(sample_time, x, y, z))
+            # buffered; about flush_interval of samples is lost on power loss at most
+            if sample_time - self.flush_time >= self.flush_interval:
+                self.file.flush()
+                self.flush_time = sample_time
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def _read_labels(path):
+    labels = []
+    try:
+        with open(path) as file:
+            for row in csv.reader(file):
+                if not row or row[0].lstrip().startswith("#"):
+                    continue
+                try:
+                    labels.append((float(row[0]), float(row[1])))
+                except (ValueError, IndexError):
+                    # header line
+                    continue
+    except FileNotFoundError:
+        pass
+    return labels
+
+
+def read_trace(path):
+    """
+    Read a trace: *.csv with columns time,x,y,z (header optional) or binary
+    telemetry (anything else). Crash windows are read from '<path>.labels',
+    a CSV of start,end per line; traces without it contain no crash.
+    Returns: Trace
+    """
+    times, peaks = [], []
+    if path.endswith(".csv"):
+        with open(path) as file:
+            for row in csv.reader(file):
+                try:
+                    sample_time, *accl_xyz = (float(val) for val in row[:4])
+                except ValueError:
+                    continue
+                times.append(sample_time)
+                peaks.append(peak_g(accl_xyz))
+    else:
+        with open(path, "rb") as file:
+            data = file.read()
+        record_size = struct.calcsize(SAMPLE_FORMAT)
+        # a torn last record (power loss) is ignored
+        data = data[:len(data) - len(data) % record_size]
+        for sample_time, *accl_xyz in struct.iter_unpack(SAMPLE_FORMAT, data):
+            times.append(sample_time)
+            peaks.append(peak_g(accl_xyz))
+    return Trace(os.path.basename(path), times, peaks, _read_labels(f"{path}.labels"))
+
+
+def _decimation(trace, sample_rate):
+    trace_rate = trace.sample_rate()
+    if not trace_rate or not sample_rate:
+        return 1
+    return max(1, round(trace_rate / sample_rate))
+
+
+def replay_trace(trace, g_force_limit, sample_rate, holdoff=10, tolerance=1):
+    """
+    Replay a trace sample by sample, as the dashcam would see it at
+    sample_rate: a trigger starts a save, further triggers within holdoff
+    seconds belong to it. A crash window counts as detected by the first
+    trigger within [start, end + tolerance] (a trigger may count for several
+    windows); triggers outside all windows are false. This is the reference
+    for evaluate_grid().
+    Returns: (number of detected windows, false triggers, latencies in s)
+    """
+    step = _decimation(trace, sample_rate)
+    windows = [(start, end + tolerance) for start, end in trace.labels]
+    detected = {}
+    false_triggers = 0
+    last_exceeding = None
+    for sample_time, peak in zip(trace.times[::step], trace.peaks[::step]):
+        if not peak > g_force_limit:
+            continue
+        # the same comparison as _preceding_max(), so both agree on the edge
+        is_start = last_exceeding is None or sample_time - last_exceeding > holdoff
+        last_exceeding = sample_time
+        matching = [
+            idx for idx, (start, end) in enumerate(windows) if start <= sample_time <= end
+        ]
+        for window in matching:
+            detected.setdefault(window, sample_time - windows[window][0])
+        if not matching and is_start:
+            false_triggers += 1
+    return len(detected), false_triggers, list(detected.values())
+
+
+def _preceding_max(times, peaks, holdoff):
+    # max of the peaks of the preceding samples w with t - times[w] <= holdoff
+    # for every sample (monotonic deque)
+    result = []
+    window = deque()
+    for idx, sample_time in enumerate(times):
+        while window and sample_time - times[window[0]] > holdoff:
+            window.popleft()
+        result.append(peaks[window[0]] if window else -1.0)
+        while window and peaks[window[-1]] <= peaks[idx]:
+            window.pop()
+        window.append(idx)
+    return result
+
+
+def _evaluate_trace(trace, limits, step, holdoff, tolerance):
+    """
+    All limits at once for one trace and decimation.
+    Returns: (detected per limit, false triggers per limit, latencies per limit)
+    """
+    times, peaks = trace.times[::step], trace.peaks[::step]
+    count = len(limits)
+    detected = [0] * count
+    latencies = [[] for _ in range(count)]
+    inside = [False] * len(times)
+    for start, end in trace.labels:
+        low, high = bisect_left(times, start), bisect_right(times, end + tolerance)
+        for idx in range(low, high):
+            inside[idx] = True
+        if low == high:
+            continue
+        # the first sample beyond a limit is where the running max passes it
+        running_max = list(accumulate(peaks[low:high], max))
+        if numpy is not None:
+            first = numpy.searchsorted(running_max, limits, side="right")
+            hits = first < len(running_max)
+            first_times = numpy.asarray(times[low:high])[numpy.minimum(first, len(running_max) - 1)]
+            for idx in numpy.nonzero(hits)[0]:
+                detected[idx] += 1
+                latencies[idx].append(first_times[idx] - start)
+        else:
+            for idx, limit in enumerate(limits):
+                first = bisect_right(running_max, limit)
+                if first < len(running_max):
+                    detected[idx] += 1
+                    latencies[idx].append(times[low + first] - start)
+    # a sample outside the windows is a false trigger for every limit in
+    # [max of the preceding holdoff, its own peak)
+    preceding = _preceding_max(times, peaks, holdoff)
+    starts_from = sorted(
+        preceding[idx] for idx in range(len(times))
+        if not inside[idx] and preceding[idx] < peaks[idx]
+    )
+    starts_until = sorted(
+        peaks[idx] for idx in range(len(times))
+        if not inside[idx] and preceding[idx] < peaks[idx]
+    )
+    if numpy is not None:
+        false_triggers = (
+            numpy.searchsorted(starts_from, limits, side="right")
+            - numpy.searchsorted(starts_until, limits, side="right")
+        ).tolist()
+    else:
+        false_triggers = [
+            bisect_right(starts_from, limit) - bisect_right(starts_until, limit)
+            for limit in limits
+        ]
+    return detected, false_triggers, latencies
+
+
+def evaluate_grid(traces, limits, sample_rates, holdoff=10, tolerance=1):
+    """
+    Evaluate every combination of g-force limit and sample rate over all
+    traces; same semantics as replay_trace().
+    Keyword Arguments:
+        traces -- list of Trace
+        limits -- g-force limits to evaluate
+        sample_rates -- sample rates in Hz (traces are decimated to them)
+        holdoff -- seconds a trigger covers further exceedances
+        tolerance -- seconds after a labelled window a trigger still counts
+    Returns: list of dicts, one per combination
+    """
+    limits = sorted(limits)
+    events = sum(len(trace.labels) for trace in traces)
+    results = []
+    for sample_rate in sample_rates:
+        detected = [0] * len(limits)
+        false_triggers = [0] * len(limits)
+        latencies = [[] for _ in limits]
+        for trace in traces:
+            step = _decimation(trace, sample_rate)
+            trace_detected, trace_false, trace_latencies = _evaluate_trace(
+                trace, limits, step, holdoff, tolerance
+            )
+            for idx in range(len(limits)):
+                detected[idx] += trace_detected[idx]
+                false_triggers[idx] += trace_false[idx]
+                latencies[idx] += trace_latencies[idx]
+        for idx, limit in enumerate(limits):
+            triggers = detected[idx] + false_triggers[idx]
+            precision = detected[idx] / triggers if triggers else None
+            recall = detected[idx] / events if events else None
+            results.append({
+                "g_force_limit": limit,
+                "sample_rate": sample_rate,
+                "events": events,
+                "detected": detected[idx],
+                "false_triggers": false_triggers[idx],
+                "precision": precision,
+                "recall": recall,
+                "f1": (
+                    2 * precision * recall / (precision + recall)
+                    if precision and recall else 0
+                ),
+                "latency_avg_ms": (
+                    sum(latencies[idx]) / len(latencies[idx]) * 1000
+                    if latencies[idx] else None
+                ),
+                "latency_max_ms": max(latencies[idx]) * 1000 if latencies[idx] else None,
+            })
+    return results
+
+
+def _parse_range(value):
+    # start:stop:step (stop inclusive) or a single value
+    parts = [float(part) for part in value.split(":")]
+    if len(parts) == 1:
+        return parts
+    start, stop, step = parts
+    count = int(round((stop - start) / step)) + 1
+    return [round(start + idx * step, 6) for idx in range(count)]
+
+
+def _format(value, digits=3):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def main():
+    import argparse
+    from time import monotonic
+
+    parser = argparse.ArgumentParser(
+        description="Replay accelerometer traces and sweep the crash detection parameters."
+    )
+    parser.add_argument(
+        "traces", metavar="TRACE", nargs="+",
+        help="CSV (time,x,y,z) or binary telemetry files; labels in <TRACE>.labels"
+    )
+    parser.add_argument(
+        "--limits", metavar="L", type=str, default="1.0:4.0:0.01",
+        help="g-force limits as start:stop:step or single value (default: 1.0:4.0:0.01)"
+    )
+    parser.add_argument(
+        "--sample_rates", metavar="HZ", type=float, nargs="+", default=[2, 5, 10, 25, 50, 100],
+        help="Sample rates in Hz to evaluate."
+    )
+    parser.add_argument("--holdoff", metavar="S", type=float, default=10)
+    parser.add_argument("--tolerance", metavar="S", type=float, default=1)
+    parser.add_argument(
+        "--top", metavar="N", type=int, default=20, help="Print the best N settings."
+    )
+    parser.add_argument("--csv", metavar="FILE", type=str, default=None, help="Write all results.")
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="Re-check the best setting with the sample by sample replay."
+    )
+    args = parser.parse_args()
+
+    traces = [read_trace(path) for path in args.traces]
+    limits = []
+    for value in args.limits.split(","):
+        limits += _parse_range(value)
+    start = monotonic()
+    results = evaluate_grid(traces, limits, args.sample_rates, args.holdoff, args.tolerance)
+    print(
+        f"Evaluated {len(results)} settings over {len(traces)} traces "
+        f"({sum(len(trace.times) for trace in traces)} samples, "
+        f"{sum(len(trace.labels) for trace in traces)} crashes) "
+        f"in {monotonic() - start:.2f}s{'' if numpy is not None else ' (without numpy)'}."
+    )
+    ranked = sorted(
+        results, key=lambda row: (-row["f1"], row["latency_avg_ms"] or 0, -row["g_force_limit"])
+    )
+    print("limit  rate_hz  detected  false  precision  recall  latency_avg_ms  latency_max_ms")
+    for row in ranked[:args.top]:
+        print(
+            f"{row['g_force_limit']:5.2f}  {row['sample_rate']:7g}  "
+            f"{row['detected']:4d}/{row['events']:<3d}  {row['false_triggers']:5d}  "
+            f"{_format(row['precision']):>9}  {_format(row['recall']):>6}  "
+            f"{_format(row['latency_avg_ms'], 1):>14}  {_format(row['latency_max_ms'], 1):>14}"
+        )
+    if args.csv is not None:
+        with open(args.csv, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    if args.verify and ranked:
+        best = ranked[0]
+        detected, false_triggers = 0, 0
+        for trace in traces:
+            trace_detected, trace_false, _ = replay_trace(
+                trace, best["g_force_limit"], best["sample_rate"], args.holdoff, args.tolerance
+            )
+            detected += trace_detected
+            false_triggers += trace_false
+        matches = (detected, false_triggers) == (best["detected"], best["false_triggers"])
+        print(f"Replay of the best setting: {detected} detected, {false_triggers} false "
+              f"({'matches' if matches else 'DIFFERS'}).")
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
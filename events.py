@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+This module provides a small in-process publish/subscribe bus that the dashcam
+threads use to tell each other about segment lifecycle and state changes,
+instead of polling shared attributes in fixed intervals.
+Every subscriber owns a queue; publishing never blocks the publisher (e.g. the
+recorder thread) and a waiting subscriber wakes up as soon as an event arrives.
+Forwarders can be attached to pass events on to other processes; events that
+came from there are delivered locally only.
+Classes:
+    Event
+    Subscription
+    EventBus
+"""
+from collections import namedtuple
+from queue import Queue, Empty
+from threading import Lock
+from time import monotonic
+
+SEGMENT_STARTED = "segment_started"
+SEGMENT_CLOSED = "segment_closed"
+INCIDENT_REQUESTED = "incident_requested"
+STATE_CHANGED = "state_changed"
+CONTROL_REQUESTED = "control_requested"
+CONFIG_CHANGED = "config_changed"
+STILLS_WRITTEN = "stills_written"
+
+EVENT_TYPES = (
+    SEGMENT_STARTED,
+    SEGMENT_CLOSED,
+    INCIDENT_REQUESTED,
+    STATE_CHANGED,
+    CONTROL_REQUESTED,
+    CONFIG_CHANGED,
+    STILLS_WRITTEN,
+)
+
+# time is taken from time.monotonic() when publishing
+Event = namedtuple("Event", ("type", "time", "data"))
+
+
+class Subscription():
+    """
+    Queue of events of the subscribed types; created via EventBus.subscribe().
+    """
+    def __init__(self, bus, event_types):
+        self.bus = bus
+        self.event_types = frozenset(event_types)
+        self.queue = Queue()
+
+    def get(self, timeout=None):
+        """
+        Wait for the next event.
+        Keyword Arguments:
+            timeout -- seconds to wait at most; None waits forever
+        Returns: Event or None if the timeout passed
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Wait for the first event for which predicate(event) is true; all
+        other events are dropped.
+        Returns: Event or None if the timeout passed
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - monotonic())
+            event = self.get(remaining)
+            if event is None or predicate(event):
+                return event
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EventBus():
+    """
+    Publish/subscribe bus with a fixed set of event types (EVENT_TYPES).
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.subscriptions = []
+        self.forwarders = []
+
+    def add_forwarder(self, forwarder):
+        """
+        Call forwarder(event) for every event published on this bus; must not
+        block, e.g. put the event into a multiprocessing queue.
+        """
+        with self.lock:
+            self.forwarders.append(forwarder)
+
+    def subscribe(self, *event_types):
+        for event_type in event_types:
+            if event_type not in EVENT_TYPES:
+                raise ValueError(f"Unknown event type '{event_type}'")
+        subscription = Subscription(self, event_types)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def publish(self, event_type, **data):
+        if event_type not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type '{event_type}'")
+        event = Event(event_type, monotonic(), data)
+        self.publish_remote(event)
+        with self.lock:
+            forwarders = list(self.forwarders)
+        for forwarder in forwarders:
+            forwarder(event)
+        return event
+
+    def publish_remote(self, event):
+        """
+        Deliver an event that was published on another (process') bus to the
+        local subscribers only, keeping its original time.
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            if event.type in subscription.event_types:
+                subscription.queue.put(event)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+This module provides the recorder health watchdog of the dashcam: it tells from the
+segment byte growth and the split cadence whether the recorder still makes
+progress, and speaks the systemd notify protocol (READY=1, WATCHDOG=1), so
+systemd restarts the service if the dashcam can not recover by itself.
+Classes:
+    RecorderWatchdog
+Functions:
+    sd_notify
+    watchdog_period
+"""
+import os
+import socket
+
+
+def sd_notify(state):
+    """
+    Send a state (e.g. "READY=1" or "WATCHDOG=1") to systemd; does nothing if
+    not started by systemd with Type=notify.
+    Returns: True if sent
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address.startswith("@"):
+        # abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+        return True
+    except OSError as error:
+        print(f"WARNING! Could not notify systemd: {error}")
+        return False
+
+
+def watchdog_period(default=1):
+    """
+    Returns: seconds between WATCHDOG=1 notifications; half of WatchdogSec
+             if systemd expects them, else default
+    """
+    try:
+        watchdog_usec = int(os.environ.get("WATCHDOG_USEC", 0))
+    except ValueError:
+        watchdog_usec = 0
+    if watchdog_usec <= 0:
+        return default
+    return min(default, watchdog_usec / 1e6 / 2)
+
+
+class RecorderWatchdog():
+    """
+    Decides whether a recording makes progress: encoded bytes have to keep
+    coming and segments have to be split on time.
+    Keyword Arguments:
+        stall_timeout -- seconds without any encoded byte (default: 5)
+        split_grace -- seconds a split may be overdue (default: 10)
+    """
+    def __init__(self, stall_timeout=5, split_grace=10):
+        self.stall_timeout = stall_timeout
+        self.split_grace = split_grace
+        self.last_progress = None
+        self.last_progress_time = None
+
+    def reset(self, now):
+        self.last_progress = None
+        self.last_progress_time = now
+
+    def check(self, now, recorder_alive, progress, last_split_time, sequence_seconds):
+        """
+        Keyword Arguments:
+            now -- current monotonic time
+            recorder_alive -- whether the recorder thread still runs
+            progress -- anything that changes while data is written, e.g.
+                        (segment filename, bytes written)
+            last_split_time -- monotonic time the current segment started
+            sequence_seconds -- length the current segment was started with
+        Returns: None if healthy, else the reason of the stall
+        """
+        if not recorder_alive:
+            return "recorder thread died"
+        if progress != self.last_progress or self.last_progress_time is None:
+            self.last_progress = progress
+            self.last_progress_time = now
+        elif now - self.last_progress_time > self.stall_timeout:
+            return f"no encoded data for {now - self.last_progress_time:.1f}s"
+        if (
+            last_split_time is not None
+            and now - last_split_time > sequence_seconds + self.split_grace
+        ):
+            return f"split overdue by {now - last_split_time - sequence_seconds:.1f}s"
+        return None
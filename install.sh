@@ -15,7 +15,7 @@ DASHCAM_ROOT_LEGAL=$DASHCAM_ROOT"/legal"
 echo "Install necessary packages (python-venv, pip)"
 sudo apt install python3-venv python3-pip pigpio
 
-for DCFile in dashcam.py led.py switch.py;
+for DCFile in dashcam.py led.py switch.py movement.py preview.py segment.py recovery.py events.py metrics.py sampler.py store.py isolation.py upload.py detection.py config.py health.py catalog.py;
 do
     echo "Copy file "$DCFile" to "$DASHCAM_ROOT/$DCFile
     sudo cp $DCFile $DASHCAM_ROOT/$DCFile
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+This module provides the process-isolated architecture of the dashcam.
+Instead of running everything as threads of one CPython process (sharing one
+GIL), the camera/segment writer, the sensor sampling/detection and the
+incident/retention handling each run in their own process; the main process
+keeps the buttons and LEDs and acts as supervisor.
+The processes are coordinated via their event buses, bridged over a small
+control channel (multiprocessing queues), and shared-memory rings for the
+sensor samples and the per-process CPU and latency stats.
+Classes:
+    ShmRing
+    ShmStats
+    EventBridge
+    ProcessStatsReporter
+    ProcessSupervisor
+Functions:
+    run_component
+"""
+import os
+import signal
+import struct
+import multiprocessing
+from multiprocessing import shared_memory
+from threading import Thread, Lock, Event
+from time import monotonic, sleep
+
+import events
+from detection import SAMPLE_FORMAT
+
+ROLES = ("recorder", "sensor", "incident")
+SUPERVISOR_ROLE = "ui"
+
+# per role the metrics gauge that tells about its own critical path
+ROLE_LATENCY_GAUGES = {
+    "recorder": "recorder.split_ms",
+    "sensor": "g_force_sampler.max_lateness_ms",
+    "incident": "incident.save_ms",
+}
+
+
+class ShmRing():
+    """
+    Single-writer ring of fixed-size records in shared memory. Readers keep
+    their own position; records overwritten before a reader got to them are
+    skipped and counted.
+    Keyword Arguments:
+        record_format -- struct format of one record
+        capacity -- number of records in the ring (ignored when attaching)
+        name -- name of an existing ring to attach to (default: None -> create)
+    """
+    HEADER = struct.Struct("<Q")
+
+    def __init__(self, record_format, capacity, name=None):
+        self.record = struct.Struct(record_format)
+        size = ShmRing.HEADER.size + capacity * self.record.size
+        self.is_owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.is_owner, size=size)
+        self.name = self.shm.name
+        # attaching processes take the capacity from the existing ring
+        self.capacity = (self.shm.size - ShmRing.HEADER.size) // self.record.size
+        self.read_count = self.count()
+        self.lost_records = 0
+
+    def count(self):
+        # the 64 bit counter is not written atomically on 32 bit ARM
+        while True:
+            first = ShmRing.HEADER.unpack_from(self.shm.buf, 0)[0]
+            second = ShmRing.HEADER.unpack_from(self.shm.buf, 0)[0]
+            if first == second:
+                return first
+
+    def _offset(self, position):
+        return ShmRing.HEADER.size + (position % self.capacity) * self.record.size
+
+    def write(self, *values):
+        count = self.count()
+        self.record.pack_into(self.shm.buf, self._offset(count), *values)
+        ShmRing.HEADER.pack_into(self.shm.buf, 0, count + 1)
+
+    def read_new(self):
+        """
+        Returns: list of records (tuples) written since the last call
+        """
+        count = self.count()
+        # one slot margin for the record the writer might be working on
+        start = max(self.read_count, count - self.capacity + 1)
+        self.lost_records += start - self.read_count
+        records = [
+            self.record.unpack_from(self.shm.buf, self._offset(position))
+            for position in range(start, count)
+        ]
+        overwritten = self.count() - self.capacity + 1 - start
+        if overwritten > 0:
+            records = records[overwritten:]
+            self.lost_records += overwritten
+        self.read_count = count
+        return records
+
+    def close(self):
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
+
+
+class ShmStats():
+    """
+    Table of per-process stats slots in shared memory; every slot is written
+    by one process only and guarded by a sequence number (odd while writing).
+    Keyword Arguments:
+        slots -- number of slots
+        name -- name of an existing table to attach to (default: None -> create)
+    """
+    # sequence, pid, update time, cpu %, rss kB, event latency avg/max ms, role latency ms
+    SLOT = struct.Struct("<QQdddddd")
+    FIELDS = (
+        "pid", "updated", "cpu_percent", "rss_kb", "event_latency_avg_ms",
+        "event_latency_max_ms", "role_latency_ms"
+    )
+
+    def __init__(self, slots, name=None):
+        self.slots = slots
+        self.is_owner = name is None
+        self.shm = shared_memory.SharedMemory(
+            name=name, create=self.is_owner, size=slots * ShmStats.SLOT.size
+        )
+        self.name = self.shm.name
+        self.sequences = [0] * slots
+
+    def write(self, slot, *values):
+        offset = slot * ShmStats.SLOT.size
+        self.sequences[slot] += 1
+        writing, written = self.sequences[slot] * 2 - 1, self.sequences[slot] * 2
+        struct.pack_into("<Q", self.shm.buf, offset, writing)
+        ShmStats.SLOT.pack_into(self.shm.buf, offset, writing, *values)
+        struct.pack_into("<Q", self.shm.buf, offset, written)
+
+    def read(self, slot):
+        offset = slot * ShmStats.SLOT.size
+        while True:
+            values = ShmStats.SLOT.unpack_from(self.shm.buf, offset)
+            if values[0] % 2 == 0 and struct.unpack_from("<Q", self.shm.buf, offset)[0] == values[0]:
+                return dict(zip(ShmStats.FIELDS, values[1:]))
+            sleep(0)
+
+    def close(self):
+        self.shm.close()
+        if self.is_owner:
+            self.shm.unlink()
+
+
+class EventBridge():
+    """
+    Connects the event bus of a component process to the supervisor: local
+    events go out to the hub, events of the other processes come in and are
+    published locally only. Measures the delivery latency of incoming events.
+    """
+    def __init__(self, bus, role, to_hub, from_hub):
+        self.bus = bus
+        self.role = role
+        self.to_hub = to_hub
+        self.from_hub = from_hub
+        self.lock = Lock()
+        self.latencies = []
+
+    def _forward(self, event):
+        self.to_hub.put((self.role, event))
+
+    def _receive_thread(self):
+        while True:
+            _, event = self.from_hub.get()
+            # CLOCK_MONOTONIC is system wide, so times of processes compare
+            with self.lock:
+                self.latencies.append(monotonic() - event.time)
+            self.bus.publish_remote(event)
+
+    def take_latencies(self):
+        with self.lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def attach(self):
+        """
+        Forward the local events to the hub; before the components start, so
+        none of their first events (e.g. the camera state) get lost.
+        """
+        self.bus.add_forwarder(self._forward)
+
+    def start(self):
+        """
+        Deliver the events of the other processes; they wait in the queue
+        until the local subscriptions are set up.
+        """
+        Thread(target=self._receive_thread, daemon=True).start()
+
+
+class ProcessStatsReporter():
+    """
+    Writes CPU usage, memory and latencies of the current process into its
+    stats slot once per interval.
+    """
+    def __init__(self, stats, slot, role, metrics, take_latencies, interval=1):
+        self.stats = stats
+        self.slot = slot
+        self.role = role
+        self.metrics = metrics
+        self.take_latencies = take_latencies
+        self.interval = interval
+
+    def _rss_kb(self):
+        try:
+            with open("/proc/self/statm") as file:
+                return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024
+        except (OSError, ValueError, IndexError):
+            return 0
+
+    def run(self):
+        last_times = os.times()
+        last_time = monotonic()
+        while True:
+            sleep(self.interval)
+            times = os.times()
+            now = monotonic()
+            cpu_percent = (
+                (times.user + times.system - last_times.user - last_times.system)
+                / (now - last_time) * 100
+            )
+            last_times, last_time = times, now
+            latencies = self.take_latencies()
+            role_latency = self.metrics.snapshot()["gauges"].get(
+                ROLE_LATENCY_GAUGES.get(self.role), 0
+            )
+            self.stats.write(
+                self.slot, os.getpid(), now, cpu_percent, self._rss_kb(),
+                sum(latencies) / len(latencies) * 1000 if latencies else 0,
+                max(latencies) * 1000 if latencies else 0,
+                role_latency if isinstance(role_latency, (int, float)) else 0
+            )
+
+
+def run_component(
+        role, slot, init_kwargs, video_file_path, salt, to_hub, from_hub,
+        sample_ring_name, stats_name):
+    """
+    Entry point of a component process: builds its own Dashcam that only runs
+    the given component and bridges its events to the supervisor.
+    """
+    # the main module imports this one; import here to not be circular
+    from dashcam import Dashcam
+
+    # config reloads reach this process as event from the supervisor
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    dashcam = Dashcam(**init_kwargs)
+    dashcam.set_video_path(video_file_path)
+    dashcam.video_name_salt = salt
+    dashcam.process_role = role
+    sample_ring = None
+    if role == "sensor":
+        sample_ring = ShmRing(SAMPLE_FORMAT, 0, name=sample_ring_name)
+        dashcam.sample_sinks.append(sample_ring.write)
+    stats = ShmStats(len(ROLES) + 1, name=stats_name)
+
+    bridge = EventBridge(dashcam.bus, role, to_hub, from_hub)
+    bridge.attach()
+    # subscriptions are set up in start(); only then let the events in
+    dashcam.start(components=(role,))
+    bridge.start()
+    ProcessStatsReporter(stats, slot, role, dashcam.metrics, bridge.take_latencies).run()
+
+
+class ProcessSupervisor():
+    """
+    Spawns one process per component role, relays the events between them
+    (and the supervisor's own bus) and collects their stats into the
+    supervisor's metrics. Dead components are restarted; if one keeps on
+    dying, the supervisor gives up, so systemd restarts the whole service.
+    The last STATE_CHANGED event per key is kept and replayed to every newly
+    spawned component, which would otherwise not know e.g. the camera state.
+    Keyword Arguments:
+        dashcam -- the supervisor's Dashcam (runs the ui component)
+        init_kwargs -- constructor arguments to build the component Dashcams with
+        sample_capacity -- number of sensor samples the shared ring holds
+        max_restarts -- restarts of one component within restart_window (default: 5)
+        restart_window -- seconds (default: 600)
+    """
+    def __init__(
+            self, dashcam, init_kwargs, sample_capacity=4096, max_restarts=5,
+            restart_window=600):
+        self.dashcam = dashcam
+        self.init_kwargs = init_kwargs
+        self.sample_capacity = sample_capacity
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.context = multiprocessing.get_context("spawn")
+        self.processes = {}
+        self.queues = {}
+        self.restart_times = {role: [] for role in ROLES}
+        self.failed = Event()
+        # key -> (origin, last STATE_CHANGED event); the lock keeps replay
+        # and relay of the states in order
+        self.states = {}
+        self.state_lock = Lock()
+        self.latency_lock = Lock()
+        self.latencies = []
+
+    def _relay(self, origin, event):
+        with self.state_lock:
+            if event.type == events.STATE_CHANGED:
+                self.states[event.data.get("key")] = (origin, event)
+            for role, queue in self.queues.items():
+                if role != origin:
+                    queue.put((origin, event))
+
+    def _forward_local(self, event):
+        self._relay(SUPERVISOR_ROLE, event)
+
+    def _hub_thread(self):
+        while True:
+            origin, event = self.to_hub.get()
+            self._relay(origin, event)
+            with self.latency_lock:
+                self.latencies.append(monotonic() - event.time)
+            self.dashcam.bus.publish_remote(event)
+
+    def _take_latencies(self):
+        with self.latency_lock:
+            latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def _collect_thread(self):
+        metrics = self.dashcam.metrics
+        samples = 0
+        while True:
+            sleep(1)
+            for slot, role in enumerate(ROLES + (SUPERVISOR_ROLE,)):
+                for key, value in self.stats.read(slot).items():
+                    metrics.set_gauge(f"process.{role}.{key}", value)
+            for role, process in list(self.processes.items()):
+                metrics.set_gauge(f"process.{role}.alive", process.is_alive())
+                if not process.is_alive():
+                    self._restart(role, process.exitcode)
+            records = self.sample_ring.read_new()
+            samples += len(records)
+            metrics.set_gauge("sensor.samples", samples)
+            metrics.set_gauge("sensor.lost_samples", self.sample_ring.lost_records)
+            if records:
+                metrics.set_gauge("sensor.last_sample", list(records[-1]))
+
+    def _spawn(self, role):
+        # a fresh queue, so a restarted component does not get the backlog
+        # of events its predecessor died with, but the current states; a
+        # component republishes its own states when it starts
+        with self.state_lock:
+            self.queues[role] = self.context.Queue()
+            for origin, event in self.states.values():
+                if origin != role:
+                    # re-timed, the delivery latency is not the state's age
+                    self.queues[role].put((origin, event._replace(time=monotonic())))
+        process = self.context.Process(
+            target=run_component, name=f"dashcam-{role}",
+            args=(
+                role, ROLES.index(role), self.init_kwargs, self.dashcam.video_file_path,
+                self.dashcam.video_name_salt, self.to_hub, self.queues[role],
+                self.sample_ring.name, self.stats.name
+            )
+        )
+        process.start()
+        self.processes[role] = process
+        print(f"Started {role} process (pid {process.pid}).")
+
+    def _restart(self, role, exitcode):
+        if self.failed.is_set():
+            return
+        now = monotonic()
+        restart_times = [
+            restart_time
+            for restart_time in self.restart_times[role]
+            if now - restart_time < self.restart_window
+        ]
+        if len(restart_times) >= self.max_restarts:
+            print(
+                f"WARNING! {role} process died {len(restart_times) + 1} times "
+                f"within {self.restart_window}s. Giving up."
+            )
+            self.failed.set()
+            return
+        print(f"WARNING! {role} process died (exit code {exitcode}). Restarting.")
+        self.restart_times[role] = restart_times + [now]
+        self.dashcam.metrics.increment(f"process.{role}.restarts")
+        self._spawn(role)
+
+    def start(self):
+        self.to_hub = self.context.Queue()
+        self.sample_ring = ShmRing(SAMPLE_FORMAT, self.sample_capacity)
+        self.stats = ShmStats(len(ROLES) + 1)
+        for role in ROLES:
+            self._spawn(role)
+        self.dashcam.bus.add_forwarder(self._forward_local)
+        Thread(target=self._hub_thread, daemon=True).start()
+        Thread(target=self._collect_thread, daemon=True).start()
+        reporter = ProcessStatsReporter(
+            self.stats, len(ROLES), SUPERVISOR_ROLE, self.dashcam.metrics,
+            self._take_latencies
+        )
+        Thread(target=reporter.run, daemon=True).start()
+
+    def join(self):
+        """
+        Blocks until a component could not be kept running; then stops the
+        others and exits the process (non-daemon threads of the ui component
+        would keep it alive), so systemd restarts the service.
+        """
+        self.failed.wait()
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+        self.sample_ring.close()
+        self.stats.close()
+        os._exit(1)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+This module provides a thread-safe collection of runtime metrics (counters and
+gauges) of the dashcam. It can subscribe itself to the event bus and is dumped
+as JSON file next to the videos, so it can be read without any extra tooling.
+Classes:
+    Metrics
+"""
+import os
+import json
+from threading import Lock, Thread
+from time import time
+
+import events
+
+
+class Metrics():
+    """
+    Named counters and gauges; names are free-form dotted strings like
+    'segments.closed' or 'startup.first_frame'.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "time": time(),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+            }
+
+    def write(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.snapshot(), file, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def _event_thread(self, subscription, path):
+        while True:
+            event = subscription.get()
+            self.increment(f"events.{event.type}")
+            if event.type == events.SEGMENT_CLOSED:
+                self.increment("segments.bytes", event.data.get("size", 0))
+                self.set_gauge("segments.last_size", event.data.get("size", 0))
+                if path is not None:
+                    try:
+                        self.write(path)
+                    except OSError as error:
+                        print(f"WARNING! Could not write metrics to '{path}': {error}")
+            elif event.type == events.STATE_CHANGED:
+                self.set_gauge(f"state.{event.data['key']}", event.data["value"])
+
+    def subscribe_to(self, bus, path=None):
+        """
+        Count all events of the bus in a background thread; the metrics file
+        is rewritten whenever a segment is closed.
+        Keyword Arguments:
+            bus -- events.EventBus
+            path -- optional JSON file to dump the metrics into
+        """
+        subscription = bus.subscribe(*events.EVENT_TYPES)
+        thread = Thread(target=self._event_thread, args=(subscription, path), daemon=True)
+        thread.start()
+        return thread
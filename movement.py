@@ -2,10 +2,47 @@
 """
 """
 from math import log2, fabs
-from time import sleep
+from time import sleep, perf_counter
+from threading import Lock, RLock
 import pigpio
 
 
+class PigpioBusManager():
+    """
+    Shares one pigpio connection between all sensor instances and hands out
+    one lock per physical bus (e.g. ("i2c", 1)), so transfers of different
+    devices on the same bus never interleave.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.pi = None
+        self.users = 0
+        self.bus_locks = {}
+
+    def open(self):
+        with self.lock:
+            if self.pi is None:
+                self.pi = pigpio.pi()
+            self.users += 1
+            return self.pi
+
+    def close(self):
+        with self.lock:
+            self.users -= 1
+            if self.users <= 0 and self.pi is not None:
+                self.pi.stop()
+                self.pi = None
+                self.users = 0
+
+    def bus_lock(self, bus):
+        with self.lock:
+            if bus not in self.bus_locks:
+                self.bus_locks[bus] = RLock()
+            return self.bus_locks[bus]
+
+BUS_MANAGER = PigpioBusManager()
+
+
 class Adxl345():
     ADDR_DEV_ID = 0x00
     ADDR_RATE_BW = 0x2C
@@ -15,6 +52,27 @@ class Adxl345():
     ADDR_OFFSET_Y = 0x1F
     ADDR_OFFSET_Z = 0x20
     ADDR_POWER_CTL = 0x2D
+    ADDR_FIFO_CTL = 0x38
+    ADDR_FIFO_STATUS = 0x39
+    ADDR_THRESH_TAP = 0x1D
+    ADDR_DUR = 0x21
+    ADDR_THRESH_ACT = 0x24
+    ADDR_ACT_INACT_CTL = 0x27
+    ADDR_TAP_AXES = 0x2A
+    ADDR_INT_ENABLE = 0x2E
+    ADDR_INT_MAP = 0x2F
+    ADDR_INT_SOURCE = 0x30
+
+    INT_SINGLE_TAP = 0x40
+    INT_ACTIVITY = 0x10
+
+    FACTOR_THRESHOLD = 0.0625 # g per LSB of THRESH_TAP and THRESH_ACT
+    FACTOR_DURATION = 0.000625 # seconds per LSB of DUR
+
+    FIFO_MODE_BYPASS = 0b00
+    FIFO_MODE_FIFO = 0b01
+    FIFO_MODE_STREAM = 0b10
+    FIFO_MODE_TRIGGER = 0b11
 
     def __init__(
             self, sensitivity_range=4, data_rate_level=0):
@@ -101,6 +159,58 @@ class Adxl345():
             if axis & (1 << (idx//2))
         ]
 
+    def set_fifo_mode(self, mode=FIFO_MODE_STREAM, samples=31):
+        errmsg = f"FIFO mode '{mode}' needs to be one of 0b00, 0b01, 0b10, 0b11!"
+        if mode not in (0b00, 0b01, 0b10, 0b11):
+            raise ValueError(errmsg)
+        self.to_address(Adxl345.ADDR_FIFO_CTL, (mode << 6) | (samples & 0x1F))
+
+    def get_fifo_entries(self):
+        return self.from_address(Adxl345.ADDR_FIFO_STATUS, 1)[0] & 0x3F
+
+    def set_interrupts(self, shock_g, activity_g=None, shock_duration=0.01):
+        """
+        Let the chip itself watch for shocks (single tap function) and
+        optionally activity, both routed to the INT1 pin (active high).
+        Keyword Arguments:
+            shock_g -- acceleration threshold of a shock in g
+            activity_g -- acceleration threshold for activity in g (default: None -> off)
+            shock_duration -- max. time in seconds above threshold to count as shock
+        """
+        to_register = lambda value, factor: min(255, max(1, round(value / factor)))
+        self.to_address(
+            Adxl345.ADDR_THRESH_TAP, to_register(shock_g, Adxl345.FACTOR_THRESHOLD)
+        )
+        self.to_address(
+            Adxl345.ADDR_DUR, to_register(shock_duration, Adxl345.FACTOR_DURATION)
+        )
+        self.to_address(Adxl345.ADDR_TAP_AXES, 0x07)
+        int_enable = Adxl345.INT_SINGLE_TAP
+        if activity_g is not None:
+            self.to_address(
+                Adxl345.ADDR_THRESH_ACT, to_register(activity_g, Adxl345.FACTOR_THRESHOLD)
+            )
+            self.to_address(Adxl345.ADDR_ACT_INACT_CTL, 0xF0) # ac-coupled, x,y,z
+            int_enable |= Adxl345.INT_ACTIVITY
+        self.to_address(Adxl345.ADDR_INT_MAP, 0x00) # everything to INT1
+        self.get_interrupt_source() # clear anything pending before enabling
+        self.to_address(Adxl345.ADDR_INT_ENABLE, int_enable)
+
+    def disable_interrupts(self):
+        self.to_address(Adxl345.ADDR_INT_ENABLE, 0x00)
+
+    def get_interrupt_source(self):
+        # reading INT_SOURCE also clears the tap/activity interrupts
+        return self.from_address(Adxl345.ADDR_INT_SOURCE, 1)[0]
+
+    def get_fifo_acceleration(self):
+        # every entry has to be popped with one 6 byte block read of the
+        # data registers; oldest entry first
+        return [
+            self.get_acceleration()
+            for _ in range(self.get_fifo_entries())
+        ]
+
 
 
 class Adxl345Spi(Adxl345):
@@ -108,13 +218,17 @@ class Adxl345Spi(Adxl345):
     BITMASK_MULTI = 0x40
     ADDR_SELECT_MASK = 0x3f
 
-    def __init__(self, channel=0, mode=0b11, baudrate=2e6):
+    def __init__(self, channel=0, mode=0b11, baudrate=2e6, bus_manager=BUS_MANAGER):
         self.channel = int(channel)
         self.mode = int(mode)
         self.baudrate = int(baudrate)
 
-        self.pi = pigpio.pi()
-        self.spi = self.pi.spi_open(self.channel, self.baudrate, self.mode)
+        # all chip selects (channels) of the main SPI share its wires
+        self.bus_manager = bus_manager
+        self.pi = self.bus_manager.open()
+        self.bus_lock = self.bus_manager.bus_lock(("spi", 0))
+        with self.bus_lock:
+            self.spi = self.pi.spi_open(self.channel, self.baudrate, self.mode)
 
         super().__init__()
 
@@ -127,7 +241,8 @@ class Adxl345Spi(Adxl345):
             0xFF
             for _ in range(byte_count)
         ])
-        count, data = self.pi.spi_xfer(self.spi, bit_msg)
+        with self.bus_lock:
+            count, data = self.pi.spi_xfer(self.spi, bit_msg)
         if count != (byte_count+1) or len(data) != count:
             raise ValueError(
                 f"Returned SPI bytes from {addr} seems not to be correct!\n"
@@ -141,23 +256,227 @@ class Adxl345Spi(Adxl345):
             addr | (Adxl345Spi.BITMASK_MULTI * (len(data_values) > 1))
         ]
         bit_msg.extend(data_values)
-        self.pi.spi_xfer(self.spi, bit_msg)
+        with self.bus_lock:
+            self.pi.spi_xfer(self.spi, bit_msg)
 
     def stop(self):
-        self.pi.spi_close(self.spi)
-        self.pi.stop()
+        with self.bus_lock:
+            self.pi.spi_close(self.spi)
+        self.bus_manager.close()
 
 class Adxl345I2C(Adxl345):
-    pass
+    ADDR_I2C_DEFAULT = 0x53 # ALT ADDRESS pin low; 0x1D if high
+
+    def __init__(self, bus=1, address=ADDR_I2C_DEFAULT, bus_manager=BUS_MANAGER):
+        self.bus = int(bus)
+        self.address = int(address)
+
+        self.bus_manager = bus_manager
+        self.pi = self.bus_manager.open()
+        self.bus_lock = self.bus_manager.bus_lock(("i2c", self.bus))
+        with self.bus_lock:
+            self.i2c = self.pi.i2c_open(self.bus, self.address)
+
+        super().__init__()
+
+    def from_address(self, addr, byte_count):
+        # register address auto-increments; a single block read for all bytes
+        with self.bus_lock:
+            count, data = self.pi.i2c_read_i2c_block_data(self.i2c, addr, byte_count)
+        if count != byte_count or len(data) != count:
+            raise ValueError(
+                f"Returned I2C bytes from {addr} seems not to be correct!\n"
+                f"Found {count} bytes instead of {byte_count}"
+            )
+        return data
+
+    def to_address(self, addr, values):
+        data_values = values if isinstance(values, list) else [values]
+        with self.bus_lock:
+            if len(data_values) == 1:
+                self.pi.i2c_write_byte_data(self.i2c, addr, data_values[0])
+            else:
+                self.pi.i2c_write_i2c_block_data(self.i2c, addr, data_values)
+
+    def stop(self):
+        with self.bus_lock:
+            self.pi.i2c_close(self.i2c)
+        self.bus_manager.close()
+
+
+class FusedAdxl345():
+    """
+    Several ADXL345 (same orientation) read as one sensor: every sample is
+    read from all of them back to back on the shared bus and combined per
+    axis. "agree" keeps the smallest magnitude, so a local vibration seen by
+    one sensor only is rejected while a crash moves all of them; "mean"
+    averages. Offers the reading and interrupt interface of Adxl345; the
+    interrupts are those of the first sensor (wired to INT1).
+    Keyword Arguments:
+        sensors -- list of Adxl345 instances, running at the same data rate
+        fusion -- "agree" or "mean" (default: "agree")
+    """
+    FUSIONS = ("agree", "mean")
+
+    def __init__(self, sensors, fusion="agree"):
+        if not sensors:
+            raise ValueError("FusedAdxl345 needs at least one sensor")
+        if fusion not in FusedAdxl345.FUSIONS:
+            raise ValueError(f"Fusion '{fusion}' needs to be one of {FusedAdxl345.FUSIONS}")
+        self.sensors = list(sensors)
+        self.fusion = fusion
+        self.primary = self.sensors[0]
+        # seconds between the reads of the first and the last sensor
+        self.last_skew = 0
+        self.max_skew = 0
+
+    @property
+    def data_rate(self):
+        return min(sensor.data_rate for sensor in self.sensors)
+
+    def combine(self, readings):
+        """
+        Combine time aligned readings ([x, y, z] per sensor) into one.
+        """
+        if self.fusion == "mean":
+            return [sum(axis) / len(axis) for axis in zip(*readings)]
+        return [min(axis, key=fabs) for axis in zip(*readings)]
+
+    def _read_all(self, read):
+        # back to back without other transfers in between, so the samples
+        # are as close in time as the bus allows (bus locks are reentrant)
+        bus_locks = []
+        for sensor in self.sensors:
+            bus_lock = getattr(sensor, "bus_lock", None)
+            if bus_lock is not None and bus_lock not in bus_locks:
+                bus_locks.append(bus_lock)
+        for bus_lock in bus_locks:
+            bus_lock.acquire()
+        try:
+            readings = []
+            start = perf_counter()
+            for sensor in self.sensors:
+                readings.append(read(sensor))
+            self.last_skew = perf_counter() - start
+        finally:
+            for bus_lock in reversed(bus_locks):
+                bus_lock.release()
+        self.max_skew = max(self.max_skew, self.last_skew)
+        return readings
+
+    def get_acceleration(self):
+        return self.combine(self._read_all(lambda sensor: sensor.get_acceleration()))
+
+    def get_fifo_acceleration(self):
+        # all FIFOs fill at the same rate; align them at the newest entry
+        fifos = self._read_all(lambda sensor: sensor.get_fifo_acceleration())
+        length = min(len(fifo) for fifo in fifos)
+        return [
+            self.combine([fifo[len(fifo) - length + idx] for fifo in fifos])
+            for idx in range(length)
+        ]
+
+    def set_on(self):
+        for sensor in self.sensors:
+            sensor.set_on()
+
+    def set_off(self):
+        for sensor in self.sensors:
+            sensor.set_off()
+
+    def set_data_rate_level(self, data_rate_level):
+        for sensor in self.sensors:
+            sensor.set_data_rate_level(data_rate_level)
+
+    def set_fifo_mode(self, mode=Adxl345.FIFO_MODE_STREAM, samples=31):
+        for sensor in self.sensors:
+            sensor.set_fifo_mode(mode, samples)
+
+    def set_interrupts(self, shock_g, activity_g=None, shock_duration=0.01):
+        self.primary.set_interrupts(shock_g, activity_g, shock_duration)
+
+    def disable_interrupts(self):
+        self.primary.disable_interrupts()
+
+    def get_interrupt_source(self):
+        return self.primary.get_interrupt_source()
+
+    def stop(self):
+        for sensor in self.sensors:
+            sensor.stop()
+
+
+def benchmark(sensor, samples=1000):
+    """
+    Measure the read path of a sensor: single 6 byte data reads and FIFO
+    drains (stream mode, 32 entries).
+    Returns: dict with reads per second and latency percentiles in ms
+    """
+    latencies = []
+    start = perf_counter()
+    for _ in range(samples):
+        read_start = perf_counter()
+        sensor.get_acceleration()
+        latencies.append(perf_counter() - read_start)
+    duration = perf_counter() - start
+    latencies.sort()
+
+    sensor.set_fifo_mode(Adxl345.FIFO_MODE_STREAM)
+    sleep(32 / sensor.data_rate + 0.01)
+    fifo_start = perf_counter()
+    fifo_samples = len(sensor.get_fifo_acceleration())
+    fifo_duration = perf_counter() - fifo_start
+    sensor.set_fifo_mode(Adxl345.FIFO_MODE_BYPASS)
+
+    return {
+        "reads_per_s": samples / duration,
+        "latency_p50_ms": latencies[len(latencies) // 2] * 1000,
+        "latency_p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "latency_max_ms": latencies[-1] * 1000,
+        "fifo_samples": fifo_samples,
+        "fifo_drain_ms": fifo_duration * 1000,
+    }
 
 
 def main():
-    test = Adxl345Spi()
-    test.set_on()
-    for _ in range(10):
-        print(", ".join(str(val) for val in test.get_acceleration()))
-        sleep(1)
-    test.stop()
+    import argparse
+    parser = argparse.ArgumentParser(description="ADXL345 test and benchmark script.")
+    parser.add_argument("--bus", default="spi", choices=("spi", "i2c", "both"))
+    parser.add_argument(
+        "--spi_channels", metavar="C", type=int, nargs="+", default=[0],
+        help="SPI channels (chip selects) of the sensors; several are read fused."
+    )
+    parser.add_argument(
+        "--benchmark", metavar="N", type=int, default=0,
+        help="Compare read throughput/latency with N reads instead of printing values."
+    )
+    args = parser.parse_args()
+
+    sensors = {}
+    if args.bus in ("spi", "both"):
+        if len(args.spi_channels) > 1:
+            sensors["spi-fused"] = FusedAdxl345(
+                [Adxl345Spi(channel) for channel in args.spi_channels]
+            )
+        else:
+            sensors["spi"] = Adxl345Spi(args.spi_channels[0])
+    if args.bus in ("i2c", "both"):
+        sensors["i2c"] = Adxl345I2C()
+
+    for name, test in sensors.items():
+        test.set_on()
+        if args.benchmark > 0:
+            result = benchmark(test, args.benchmark)
+            print(f"{name}: " + ", ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in result.items()
+            ))
+            continue
+        for _ in range(10):
+            print(f"{name}: " + ", ".join(str(val) for val in test.get_acceleration()))
+            sleep(1)
+    for test in sensors.values():
+        test.stop()
 
 if __name__ == "__main__":
     # execute only if run as a script
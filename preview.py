@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+This module provides an optional live-preview HTTP server for the dashcam.
+It is mainly used to align the camera on its mount: a second encoder on a
+picamera splitter port produces a small MJPEG (or H.264) stream that is served
+to any number of local clients.
+The encoder is only running while at least one client is connected, so the
+recorder does not pay anything for the preview when nobody is looking.
+Each encoded buffer is shared between all clients as a single memoryview;
+clients that cannot keep up are dropped instead of slowing down the camera.
+Classes:
+    PreviewOutput
+    PreviewClient
+    PreviewServer
+Functions:
+    main
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, RLock
+
+
+class PreviewOutput():
+    """
+    File-like output for picamera's encoder callback. Collects the written
+    buffers to complete frames (MJPEG) or passes NAL units through (H.264) and
+    hands them over to the server's event loop without copying them per client.
+    """
+    def __init__(self, server, video_type):
+        self.server = server
+        self.video_type = video_type
+        self._parts = []
+
+    def write(self, buf):
+        if self.video_type == "mjpeg":
+            self._parts.append(buf)
+            if not buf.endswith(b"\xff\xd9"):
+                return len(buf)
+            # a frame mostly arrives in a single buffer; only join if needed
+            frame = self._parts[0] if len(self._parts) == 1 else b"".join(self._parts)
+            self._parts = []
+        else:
+            frame = buf
+        self.server.publish(memoryview(frame))
+        return len(buf)
+
+    def flush(self):
+        self._parts = []
+
+
+class PreviewClient():
+    """
+    State of a single connected streaming client.
+    """
+    def __init__(self, writer, peer):
+        self.writer = writer
+        self.peer = peer
+        self.waiting_keyframe = True
+        self.closed = asyncio.Event()
+
+
+class PreviewServer():
+    """
+    Asyncio based HTTP server, running in its own thread, that fans out the
+    preview encoder output to connected clients.
+    Keyword Arguments:
+        camera -- the picamera.PiCamera instance to record the preview from
+        port -- TCP port to listen on (default: 8000)
+        host -- address to bind to (default: "0.0.0.0")
+        video_type -- "mjpeg" or "h264" (default: "mjpeg")
+        resolution -- resize of the preview stream (default: (640, 360))
+        splitter_port -- picamera splitter port of the preview encoder (default: 1)
+        max_client_buffer -- pending bytes per client before it is dropped (default: 1 MiB)
+    """
+    BOUNDARY = b"dashcamframe"
+
+    def __init__(
+            self, camera, port=8000, host="0.0.0.0", video_type="mjpeg",
+            resolution=(640, 360), splitter_port=1, bitrate=1000000,
+            max_client_buffer=1 << 20):
+        self.camera = camera
+        self.port = port
+        self.host = host
+        self.video_type = video_type if video_type in ("h264", "mjpeg") else "mjpeg"
+        self.resolution = tuple(resolution)
+        self.splitter_port = splitter_port
+        self.bitrate = bitrate
+        self.max_client_buffer = max_client_buffer
+
+        self.clients = set()
+        self.dropped_clients = 0
+        self.output = PreviewOutput(self, self.video_type)
+        self.encoder_lock = RLock()
+        self.is_encoding = False
+        # start and stop of the encoder must never overtake each other
+        self.encoder_executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = None
+        self.server_thread = None
+
+    def publish(self, frame):
+        # called from the encoder thread; must never block the camera
+        if self.clients and self.loop is not None:
+            self.loop.call_soon_threadsafe(self._fan_out, frame)
+
+    def _fan_out(self, frame):
+        is_keyframe = (
+            self.video_type == "h264" and len(frame) > 4 and
+            frame[:4] == b"\x00\x00\x00\x01" and (frame[4] & 0x1F) == 7
+        )
+        for client in list(self.clients):
+            writer = client.writer
+            if writer.transport.get_write_buffer_size() > self.max_client_buffer:
+                print(f"Preview client {client.peer} too slow. Dropping client.")
+                self.dropped_clients += 1
+                self._drop_client(client)
+                continue
+            if self.video_type == "mjpeg":
+                writer.write(
+                    b"--" + PreviewServer.BOUNDARY + b"\r\n"
+                    b"Content-Type: image/jpeg\r\n"
+                    b"Content-Length: " + str(len(frame)).encode() + b"\r\n\r\n"
+                )
+                writer.write(frame)
+                writer.write(b"\r\n")
+            else:
+                # new H.264 clients can only start decoding at SPS headers
+                if client.waiting_keyframe and not is_keyframe:
+                    continue
+                client.waiting_keyframe = False
+                writer.write(frame)
+
+    def _drop_client(self, client):
+        self.clients.discard(client)
+        client.writer.close()
+        client.closed.set()
+
+    def _start_encoder(self):
+        with self.encoder_lock:
+            if self.is_encoding:
+                return
+            kwargs = {"resize": self.resolution, "splitter_port": self.splitter_port}
+            if self.video_type == "h264":
+                kwargs.update(bitrate=self.bitrate, inline_headers=True, intra_period=30)
+            self.camera.start_recording(self.output, format=self.video_type, **kwargs)
+            self.is_encoding = True
+
+    def _stop_encoder(self):
+        with self.encoder_lock:
+            if not self.is_encoding:
+                return
+            self.is_encoding = False
+            try:
+                self.camera.stop_recording(splitter_port=self.splitter_port)
+            except Exception as error:
+                print(f"WARNING! Stopping preview encoder failed: {error}")
+            self.output.flush()
+
+    def _update_encoder(self):
+        # clients may have come or gone since this was scheduled; decide on
+        # the current ones
+        with self.encoder_lock:
+            if self.clients:
+                self._start_encoder()
+            else:
+                self._stop_encoder()
+
+    def set_camera(self, camera):
+        """
+        Switch to a re-created camera; the encoder of the old one is gone, so
+        it is restarted on the new one if clients are connected.
+        """
+        with self.encoder_lock:
+            self.is_encoding = False
+            self.camera = camera
+            self.output.flush()
+            self._update_encoder()
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        parts = request_line.decode(errors="replace").split()
+        path = parts[1] if len(parts) > 1 else "/"
+        stream_path = "/stream.mjpg" if self.video_type == "mjpeg" else "/stream.h264"
+
+        if path == "/":
+            body = (
+                "<html><head><title>dashcam preview</title></head><body>"
+                + (
+                    f'<img src="{stream_path}" width="100%"/>'
+                    if self.video_type == "mjpeg" else
+                    f'<a href="{stream_path}">{stream_path}</a>'
+                )
+                + "</body></html>"
+            ).encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\nContent-Type: text/html\r\n"
+                b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+            )
+            await writer.drain()
+            writer.close()
+            return
+        if path != stream_path:
+            writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+            writer.close()
+            return
+
+        content_type = (
+            b"multipart/x-mixed-replace; boundary=" + PreviewServer.BOUNDARY
+            if self.video_type == "mjpeg" else b"video/h264"
+        )
+        writer.write(
+            b"HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\n"
+            b"Content-Type: " + content_type + b"\r\n\r\n"
+        )
+        client = PreviewClient(writer, peer)
+        print(f"Preview client {peer} connected.")
+        self.clients.add(client)
+        await self.loop.run_in_executor(self.encoder_executor, self._update_encoder)
+        try:
+            # clients do not send anything anymore; wait for disconnect or drop
+            closed_task = asyncio.ensure_future(client.closed.wait())
+            read_task = asyncio.ensure_future(reader.read())
+            await asyncio.wait(
+                (closed_task, read_task), return_when=asyncio.FIRST_COMPLETED
+            )
+            closed_task.cancel()
+            read_task.cancel()
+        finally:
+            self.clients.discard(client)
+            writer.close()
+            print(f"Preview client {peer} disconnected.")
+            await self.loop.run_in_executor(self.encoder_executor, self._update_encoder)
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self._handle_client, self.host, self.port)
+        print(f"Preview server listening on {self.host}:{self.port}.")
+        async with server:
+            await self.stop_event.wait()
+        for client in list(self.clients):
+            self._drop_client(client)
+        await self.loop.run_in_executor(self.encoder_executor, self._update_encoder)
+        self.encoder_executor.shutdown()
+
+    def start(self):
+        self.server_thread = Thread(target=asyncio.run, args=(self._serve(),), daemon=True)
+        self.server_thread.start()
+
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        if self.server_thread is not None:
+            self.server_thread.join()
+
+
+def main():
+    import argparse
+    import picamera
+    from time import sleep
+
+    parser = argparse.ArgumentParser(description="Stand-alone dashcam live preview.")
+    parser.add_argument("-p", "--port", type=int, default=8000)
+    parser.add_argument("-vf", "--video_format", default="mjpeg", choices=("h264", "mjpeg"))
+    args = parser.parse_args()
+
+    camera = picamera.PiCamera(resolution=(1920, 1080), framerate=30)
+    server = PreviewServer(camera, port=args.port, video_type=args.video_format)
+    server.start()
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+        camera.close()
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
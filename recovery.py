@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+This module provides the startup recovery stage of the dashcam.
+After a power cut the last segment of the previous record session is exactly
+the footage that matters, but it was never closed properly. The recovery finds
+that tail via the segment index (or, if there is none, a bounded scan of the
+video directory only), cuts off a torn trailing NAL unit/JPEG frame and returns
+the segments that should be protected from the regular cleanup.
+Functions:
+    parse_video_filename
+    find_previous_session_tail
+    trim_torn_tail
+    recover_previous_session
+"""
+import os
+from time import monotonic
+
+
+def parse_video_filename(filename, prefix, video_type):
+    """
+    Split a segment filename '<prefix>_<timestamp>-<salt>-<counter>.<type>'
+    into its parts.
+    Returns: (timestamp, salt, counter) or None if the name does not match
+    """
+    if not filename.startswith(f"{prefix}_") or not filename.endswith(f".{video_type}"):
+        return None
+    fileid = filename.removeprefix(f"{prefix}_").removesuffix(f".{video_type}")
+    parts = fileid.split("-")
+    if len(parts) != 3:
+        return None
+    try:
+        return int(parts[0]), parts[1], int(parts[2])
+    except ValueError:
+        return None
+
+
+def find_previous_session_tail(
+        index, video_file_path, prefix, video_type, current_salt, segment_count=1):
+    """
+    Find the last segments of the most recent record session that is not the
+    current one. The segment index tail is used first; a single directory
+    listing (no recursion, no stat) is the fallback.
+    Returns: list of (filename, is_closed), oldest first
+    """
+    started = []
+    closed = set()
+    for entry in index.read_tail():
+        filename = entry.get("file")
+        if entry.get("session") == current_salt or filename is None:
+            continue
+        if entry.get("event") == "started":
+            started.append((entry.get("session"), filename))
+        elif entry.get("event") == "closed":
+            closed.add(filename)
+    if started:
+        last_session = started[-1][0]
+        tail = [
+            filename
+            for session, filename in started
+            if session == last_session
+        ][-segment_count:]
+        tail = [
+            filename
+            for filename in tail
+            if os.path.isfile(os.path.join(video_file_path, filename))
+        ]
+        if tail:
+            return [(filename, filename in closed) for filename in tail]
+
+    candidates = []
+    for filename in os.listdir(video_file_path):
+        parsed = parse_video_filename(filename, prefix, video_type)
+        if parsed is not None and parsed[1] != current_salt:
+            candidates.append((parsed, filename))
+    if not candidates:
+        return []
+    candidates.sort()
+    last_salt = candidates[-1][0][1]
+    tail = [
+        filename
+        for parsed, filename in candidates
+        if parsed[1] == last_salt
+    ][-segment_count:]
+    # without index we cannot know; only the very last one can be torn
+    return [(filename, filename != tail[-1]) for filename in tail]
+
+
+def trim_torn_tail(path, video_type, window=1 << 20):
+    """
+    Cut off a possibly torn trailing unit of an unclosed segment: for H.264
+    the last NAL unit (from its start code on), for MJPEG everything after the
+    last complete JPEG frame. Only the last window bytes are read.
+    Returns: number of bytes removed
+    """
+    with open(path, "r+b") as file:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        offset = max(0, size - window)
+        file.seek(offset)
+        data = file.read()
+        if video_type == "h264":
+            position = data.rfind(b"\x00\x00\x01")
+            if position < 0:
+                return 0
+            if position > 0 and data[position - 1] == 0:
+                position -= 1
+        else:
+            position = data.rfind(b"\xff\xd9")
+            if position < 0:
+                return 0
+            position += 2
+        new_size = offset + position
+        if new_size <= 0 or new_size >= size:
+            return 0
+        file.truncate(new_size)
+        file.flush()
+        os.fsync(file.fileno())
+    return size - new_size
+
+
+def recover_previous_session(
+        index, video_file_path, prefix, video_type, current_salt, segment_count=1):
+    """
+    Run the whole recovery stage: find the tail of the previous session and
+    trim its unclosed segments.
+    Returns: list of the tail segment filenames to protect
+    """
+    start = monotonic()
+    tail = find_previous_session_tail(
+        index, video_file_path, prefix, video_type, current_salt, segment_count
+    )
+    for filename, is_closed in tail:
+        if is_closed:
+            continue
+        path = os.path.join(video_file_path, filename)
+        try:
+            removed = trim_torn_tail(path, video_type)
+        except OSError as error:
+            print(f"WARNING! Could not repair '{path}': {error}. Continue")
+            continue
+        if removed:
+            print(f"Recovery: removed {removed} torn trailing bytes from '{path}'.")
+        # mark as closed, so it is never trimmed a second time
+        parsed = parse_video_filename(filename, prefix, video_type)
+        index.append(
+            "closed", file=filename, session=parsed[1] if parsed else None,
+            size=os.path.getsize(path), recovered=True
+        )
+    protected = [filename for filename, _ in tail]
+    if protected:
+        print(
+            f"Recovery: protecting previous session tail {protected} "
+            f"(took {monotonic() - start:.3f}s)."
+        )
+    return protected
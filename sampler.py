@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+This module provides a periodic sampling loop for sensors that is driven by
+absolute monotonic deadlines instead of sleeping a fixed time after each read.
+The sample period therefore does not drift with bus and Python overhead, and
+the loop measures what it really achieves: sample rate, period jitter and
+missed deadlines.
+Classes:
+    PeriodicSampler
+Functions:
+    set_thread_priority
+"""
+import os
+from bisect import bisect_left
+from collections import deque
+from threading import get_native_id
+from time import monotonic, sleep
+
+
+def set_thread_priority(priority):
+    """
+    Elevate the scheduling priority of the calling thread; uses SCHED_FIFO
+    with the given priority (1..99) and falls back to a lower nice value.
+    Both usually need root (or CAP_SYS_NICE).
+    Returns: True if any elevation was applied
+    """
+    try:
+        # pid 0 addresses the calling thread on Linux
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+        return True
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.setpriority(os.PRIO_PROCESS, get_native_id(), -10)
+        return True
+    except (AttributeError, OSError) as error:
+        print(f"WARNING! Could not elevate sampler priority: {error}")
+        return False
+
+
+class PeriodicSampler():
+    """
+    Calls a sample function at fixed absolute deadlines start + k * period.
+    If a call overruns by one or more full periods, the skipped deadlines are
+    counted as missed instead of being caught up in a burst.
+    Keyword Arguments:
+        period -- sample period in seconds
+        sample -- callable without arguments, called once per deadline
+        priority -- optional SCHED_FIFO priority for the sampling thread (default: None)
+        metrics -- optional metrics.Metrics to publish the stats to (default: None)
+        name -- prefix for the metrics names (default: "sampler")
+    """
+    # upper bucket edges of the period jitter histogram in microseconds
+    JITTER_BUCKETS_US = (50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+    def __init__(self, period, sample, priority=None, metrics=None, name="sampler"):
+        self.period = period
+        self.sample = sample
+        self.priority = priority
+        self.metrics = metrics
+        self.name = name
+
+        self.samples = 0
+        self.missed_deadlines = 0
+        self.max_lateness = 0
+        self.jitter_histogram = [0] * (len(PeriodicSampler.JITTER_BUCKETS_US) + 1)
+        self.first_sample_time = None
+        self.last_sample_time = None
+        self.recent_sample_times = deque(maxlen=64)
+
+    def _record(self, now, deadline):
+        if self.last_sample_time is not None:
+            jitter_us = abs((now - self.last_sample_time) - self.period) * 1e6
+            self.jitter_histogram[bisect_left(PeriodicSampler.JITTER_BUCKETS_US, jitter_us)] += 1
+        else:
+            self.first_sample_time = now
+        self.max_lateness = max(self.max_lateness, now - deadline)
+        self.last_sample_time = now
+        self.recent_sample_times.append(now)
+        self.samples += 1
+
+    def achieved_rate(self):
+        """
+        Returns: sample rate in Hz over the most recent samples (0 if unknown)
+        """
+        if len(self.recent_sample_times) < 2:
+            return 0
+        duration = self.recent_sample_times[-1] - self.recent_sample_times[0]
+        return (len(self.recent_sample_times) - 1) / duration if duration > 0 else 0
+
+    def stats(self):
+        total_duration = (
+            self.last_sample_time - self.first_sample_time
+            if self.samples > 1 else 0
+        )
+        return {
+            "target_rate": 1 / self.period,
+            "achieved_rate": self.achieved_rate(),
+            "average_rate": (self.samples - 1) / total_duration if total_duration > 0 else 0,
+            "samples": self.samples,
+            "missed_deadlines": self.missed_deadlines,
+            "max_lateness_ms": self.max_lateness * 1000,
+            "jitter_histogram_us": {
+                f"<={edge}": count
+                for edge, count in zip(
+                    PeriodicSampler.JITTER_BUCKETS_US + ("inf",), self.jitter_histogram
+                )
+            },
+        }
+
+    def _publish_stats(self):
+        if self.metrics is None:
+            return
+        for key, value in self.stats().items():
+            self.metrics.set_gauge(f"{self.name}.{key}", value)
+
+    def run(self, should_continue):
+        """
+        Sample until should_continue() returns False; blocks the calling thread.
+        """
+        if self.priority:
+            set_thread_priority(self.priority)
+        # publish stats about once per second, not per sample
+        publish_every = max(1, int(1 / self.period))
+        start = monotonic()
+        index = 0
+        while should_continue():
+            deadline = start + index * self.period
+            now = monotonic()
+            if now < deadline:
+                sleep(deadline - now)
+                now = monotonic()
+            self._record(now, deadline)
+            self.sample()
+
+            index += 1
+            behind = int((monotonic() - start) / self.period) - index
+            if behind > 0:
+                self.missed_deadlines += behind
+                index += behind
+            if self.samples % publish_every == 0:
+                self._publish_stats()
+        self._publish_stats()
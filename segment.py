@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+This module provides the output objects the dashcam recorder hands over to
+picamera instead of plain filenames.
+Each SegmentWriter represents exactly one video chunk on disk and keeps track
+of what was written into it, e.g. to know when the very first encoded frame
+arrived after startup. The SHA-256 of the segment (and of every MiB of it) is
+computed while writing, so evidence can be checksummed without reading the
+file again.
+Next to the segments an append-only SegmentIndex records which segment was
+started and closed by which record session, so the tail of a previous session
+can be found after a power cut without scanning the disk.
+Classes:
+    SegmentWriter
+    SegmentIndex
+"""
+import os
+import json
+import fcntl
+import hashlib
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, time
+
+
+CHUNK_HASH_SIZE = 1 << 20
+
+
+class SegmentWriter():
+    """
+    File-like output for a single video segment; picamera calls write() from
+    its encoder thread. The writer is not closed by picamera on split, the
+    recorder has to close it once the next segment took over.
+    Keyword Arguments:
+        path -- full path of the segment file
+        on_first_write -- optional callable(writer) called after the first write
+    """
+    def __init__(self, path, on_first_write=None):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.on_first_write = on_first_write
+        self.bytes_written = 0
+        self.open_time = monotonic()
+        self.first_write_time = None
+        self.closed = False
+        self.sha256 = hashlib.sha256()
+        self.chunk_sha256 = []
+        self._chunk = hashlib.sha256()
+        self._chunk_fill = 0
+        self._file = open(path, "wb")
+
+    def _hash(self, buf):
+        self.sha256.update(buf)
+        view = memoryview(buf)
+        while view:
+            take = min(len(view), CHUNK_HASH_SIZE - self._chunk_fill)
+            self._chunk.update(view[:take])
+            self._chunk_fill += take
+            view = view[take:]
+            if self._chunk_fill == CHUNK_HASH_SIZE:
+                self.chunk_sha256.append(self._chunk.hexdigest())
+                self._chunk = hashlib.sha256()
+                self._chunk_fill = 0
+
+    def write(self, buf):
+        written = self._file.write(buf)
+        self._hash(buf)
+        self.bytes_written += written
+        if self.first_write_time is None:
+            self.first_write_time = monotonic()
+            if self.on_first_write is not None:
+                self.on_first_write(self)
+        return written
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._file.close()
+        if self._chunk_fill:
+            self.chunk_sha256.append(self._chunk.hexdigest())
+            self._chunk_fill = 0
+
+    def digests(self):
+        """
+        Returns: dict with sha256 of the whole segment and of every MiB
+        """
+        return {"sha256": self.sha256.hexdigest(), "chunks_sha256": list(self.chunk_sha256)}
+
+
+class SegmentIndex():
+    """
+    Append-only index of segment lifecycle entries, one JSON object per line.
+    Entries are flushed and synced on every append, so after a power cut at
+    most the entry that was being written is lost (and ignored on reading).
+    Appending and compacting are locked across processes as well, e.g. the
+    recorder appends while the incident handling compacts.
+    Keyword Arguments:
+        path -- full path of the index file
+    """
+    FILENAME = ".segments.idx"
+
+    def __init__(self, path):
+        self.path = path
+        # the index itself is replaced by compact(); lock a file next to it
+        self.lock_path = f"{path}.lock"
+        self.lock = Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self.lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def append(self, event, **data):
+        entry = {"event": event, "time": time(), **data}
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self._locked():
+            with open(self.path, "a") as file:
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+        return entry
+
+    def _parse(self, lines):
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # torn last line after a power cut, or the cut first line of a tail read
+                continue
+        return entries
+
+    def read_tail(self, max_bytes=1 << 16):
+        """
+        Read only the last max_bytes of the index; enough to find the end
+        of the previous session without reading the whole history.
+        Returns: list of entries, oldest first
+        """
+        with self.lock:
+            try:
+                with open(self.path, "rb") as file:
+                    file.seek(0, os.SEEK_END)
+                    size = file.tell()
+                    file.seek(max(0, size - max_bytes))
+                    data = file.read()
+            except FileNotFoundError:
+                return []
+        return self._parse(data.decode(errors="replace").splitlines())
+
+    def read_all(self):
+        with self.lock:
+            try:
+                with open(self.path) as file:
+                    return self._parse(file.readlines())
+            except FileNotFoundError:
+                return []
+
+    def closed_digests(self):
+        """
+        Returns: dict filename -> closed entry, for entries that carry hashes
+        """
+        return {
+            entry["file"]: entry
+            for entry in self.read_all()
+            if entry.get("event") == "closed" and "sha256" in entry
+        }
+
+    def _rewrite(self, keep):
+        tmp_path = f"{self.path}.tmp"
+        # keep the lock for read and rewrite; the recorder may append meanwhile
+        with self._locked():
+            try:
+                with open(self.path) as file:
+                    entries = [
+                        entry
+                        for entry in self._parse(file.readlines())
+                        if keep(entry)
+                    ]
+            except FileNotFoundError:
+                return
+            with open(tmp_path, "w") as file:
+                for entry in entries:
+                    file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, self.path)
+
+    def compact(self, keep_files, keep_session=None):
+        """
+        Rewrite the index with only the entries of files that still exist.
+        Keyword Arguments:
+            keep_files -- collection of segment filenames to keep entries for
+            keep_session -- session whose entries are all kept, e.g. the running
+                            one, whose files may be newer than keep_files (default: None)
+        """
+        self._rewrite(
+            lambda entry: (
+                entry.get("file") in keep_files or
+                (keep_session is not None and entry.get("session") == keep_session)
+            )
+        )
+
+    def forget(self, files):
+        """
+        Rewrite the index without the entries of the given (deleted) files.
+        """
+        self._rewrite(lambda entry: entry.get("file") not in files)
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+This module provides the content-addressed storage of the legal (incident)
+area. Every video chunk is stored exactly once as blob named by its SHA-256,
+no matter how many incidents refer to it; an incident folder only holds a
+small manifest plus hard links to the blobs (where the filesystem supports
+them, e.g. not on FAT formatted USB sticks).
+Blobs are reference counted via the manifests, so deleting incidents frees
+exactly the chunks no other incident needs anymore.
+If given an IncidentCatalog, it is kept in sync with every added and deleted
+incident.
+Manifests carry the SHA-256 of every chunk (whole file and per MiB, mostly
+already computed while recording) and are signed with a device key (HMAC), so
+the evidence can be verified later on.
+Can also be used as stand-alone script to list, verify, delete and collect
+garbage.
+Classes:
+    IncidentStore
+Functions:
+    main
+"""
+import os
+import hmac
+import json
+import shutil
+import sqlite3
+import hashlib
+from time import time
+
+from segment import CHUNK_HASH_SIZE
+from catalog import IncidentCatalog
+
+
+def hash_file(path):
+    """
+    Returns: dict with sha256 of the whole file and of every MiB
+    """
+    sha256 = hashlib.sha256()
+    chunks_sha256 = []
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(CHUNK_HASH_SIZE), b""):
+            sha256.update(block)
+            chunks_sha256.append(hashlib.sha256(block).hexdigest())
+    return {"sha256": sha256.hexdigest(), "chunks_sha256": chunks_sha256}
+
+
+def load_key(key_path):
+    """
+    Read the device key used to sign manifests; a new random key is created
+    if there is none yet. Keep it outside of the (exportable) legal folder.
+    """
+    try:
+        with open(key_path, "rb") as file:
+            return file.read()
+    except FileNotFoundError:
+        pass
+    os.makedirs(os.path.dirname(key_path) or ".", exist_ok=True)
+    key = os.urandom(32)
+    fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(key)
+    return key
+
+
+class IncidentStore():
+    """
+    Blob store and incident manifests below the legal path.
+    Keyword Arguments:
+        legal_path -- the legal folder, e.g. /opt/dashcam/legal
+        key_path -- device key file to sign manifests with (default: None -> unsigned)
+        catalog -- optional catalog.IncidentCatalog to keep up to date (default: None)
+    """
+    BLOB_DIR = ".blobs"
+    MANIFEST = "manifest.json"
+
+    def __init__(self, legal_path, key_path=None, catalog=None):
+        self.legal_path = legal_path
+        self.blob_path = os.path.join(legal_path, IncidentStore.BLOB_DIR)
+        self.key = load_key(key_path) if key_path is not None else None
+        self.catalog = catalog
+
+    def _signature(self, manifest):
+        content = {key: value for key, value in manifest.items() if key != "signature"}
+        message = json.dumps(content, sort_keys=True, separators=(",", ":")).encode()
+        return {
+            "algorithm": "hmac-sha256",
+            "key_id": hashlib.sha256(self.key).hexdigest()[:16],
+            "value": hmac.new(self.key, message, hashlib.sha256).hexdigest(),
+        }
+
+    def get_blob_path(self, digest, suffix):
+        return os.path.join(self.blob_path, digest[:2], f"{digest}.{suffix}")
+
+    def put(self, src, digests=None):
+        """
+        Store a file as blob, if not yet stored.
+        Keyword Arguments:
+            src -- path of the file to store
+            digests -- dict with sha256 and chunks_sha256 of src, if already
+                       known, e.g. computed while recording (default: None -> read src)
+        Returns: (digests, size, blob path, True if the blob was newly written)
+        """
+        if digests is None:
+            digests = hash_file(src)
+        suffix = src.rsplit(".", 1)[-1]
+        blob = self.get_blob_path(digests["sha256"], suffix)
+        if os.path.isfile(blob):
+            # refresh, so a concurrent gc() does not consider it orphaned
+            os.utime(blob)
+            return digests, os.path.getsize(blob), blob, False
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        tmp_blob = f"{blob}.tmp"
+        shutil.copyfile(src, tmp_blob)
+        os.replace(tmp_blob, blob)
+        return digests, os.path.getsize(blob), blob, True
+
+    def add_incident(self, incident_path, entries, **info):
+        """
+        Reference blobs from an incident folder: hard link them under their
+        incident name (if possible) and write the manifest.
+        Keyword Arguments:
+            incident_path -- the incident folder, e.g. legal/1700000000_utc-1a2b3c4d
+            entries -- list of dicts with at least name, sha256, size and blob
+            info -- further values stored in the manifest (e.g. trigger source)
+        Returns: the manifest dict
+        """
+        os.makedirs(incident_path, exist_ok=True)
+        manifest_path = os.path.join(incident_path, IncidentStore.MANIFEST)
+        previous = None
+        try:
+            with open(manifest_path) as file:
+                previous = json.load(file)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as error:
+            print(f"WARNING! Unreadable manifest '{manifest_path}': {error} Continue")
+        for entry in entries:
+            link = os.path.join(incident_path, entry["name"])
+            try:
+                if not os.path.exists(link):
+                    os.link(entry["blob"], link)
+                entry["linked"] = True
+            except OSError:
+                # e.g. FAT; the manifest is the only reference then
+                entry["linked"] = False
+            entry["blob"] = os.path.relpath(entry["blob"], self.legal_path)
+        if previous is not None:
+            # never drop references of an incident saved to the same folder,
+            # gc() would free their blobs
+            print(f"WARNING! Incident '{incident_path}' exists. Merging files. Continue")
+            names = {entry["name"] for entry in entries}
+            entries = [
+                entry
+                for entry in previous.get("files", [])
+                if entry["name"] not in names
+            ] + entries
+        manifest = {
+            "incident": os.path.basename(incident_path),
+            "created": time(),
+            **info,
+            "files": entries,
+        }
+        if self.key is not None:
+            manifest["signature"] = self._signature(manifest)
+        tmp_manifest = os.path.join(incident_path, f"{IncidentStore.MANIFEST}.tmp")
+        with open(tmp_manifest, "w") as file:
+            json.dump(manifest, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_manifest, manifest_path)
+        self._update_catalog("add", manifest)
+        return manifest
+
+    def _update_catalog(self, method, *args):
+        # the manifests are the evidence; the catalog is only an index of them
+        if self.catalog is None:
+            return
+        try:
+            getattr(self.catalog, method)(*args)
+        except sqlite3.Error as error:
+            print(
+                f"WARNING! Incident catalog not updated: {error} Dropping it until "
+                "it is rebuilt. Continue"
+            )
+            catalog, self.catalog = self.catalog, None
+            try:
+                catalog.close()
+            except sqlite3.Error:
+                pass
+
+    def incidents(self):
+        return sorted(
+            name
+            for name in os.listdir(self.legal_path)
+            if os.path.isfile(
+                os.path.join(self.legal_path, name, IncidentStore.MANIFEST)
+            )
+        )
+
+    def read_manifest(self, incident):
+        with open(os.path.join(self.legal_path, incident, IncidentStore.MANIFEST)) as file:
+            return json.load(file)
+
+    def reference_counts(self):
+        counts = {}
+        for incident in self.incidents():
+            try:
+                manifest = self.read_manifest(incident)
+            except (OSError, ValueError) as error:
+                print(f"WARNING! Unreadable manifest of '{incident}': {error}")
+                continue
+            for entry in manifest.get("files", []):
+                blob = os.path.join(self.legal_path, entry["blob"])
+                counts[blob] = counts.get(blob, 0) + 1
+        return counts
+
+    def gc(self, grace_seconds=3600):
+        """
+        Delete blobs no manifest refers to anymore. Blobs touched within the
+        grace period are kept, as they might belong to an incident being saved.
+        Returns: (number of deleted blobs, freed bytes)
+        """
+        if not os.path.isdir(self.blob_path):
+            return 0, 0
+        counts = self.reference_counts()
+        now = time()
+        deleted, freed = 0, 0
+        for directory, _, files in os.walk(self.blob_path):
+            for file in files:
+                blob = os.path.join(directory, file)
+                if counts.get(blob, 0) > 0:
+                    continue
+                stat = os.stat(blob)
+                if now - stat.st_mtime < grace_seconds:
+                    continue
+                print(f"DELETE unreferenced blob '{blob}'")
+                os.remove(blob)
+                deleted += 1
+                freed += stat.st_size
+        return deleted, freed
+
+    def verify_incident(self, incident):
+        """
+        Re-check an incident on demand: manifest signature, and size and
+        hashes of every referenced file (reads all of them).
+        Returns: list of problems found; empty if the incident is intact
+        """
+        problems = []
+        manifest = self.read_manifest(incident)
+        signature = manifest.get("signature")
+        if signature is None:
+            problems.append("manifest is not signed")
+        elif self.key is None:
+            problems.append("no key given to check the manifest signature")
+        elif not hmac.compare_digest(
+                signature.get("value", ""), self._signature(manifest)["value"]):
+            problems.append("manifest signature does not match")
+        for entry in manifest.get("files", []):
+            path = os.path.join(self.legal_path, incident, entry["name"])
+            if not entry.get("linked", True) or not os.path.isfile(path):
+                path = os.path.join(self.legal_path, entry["blob"])
+            try:
+                size = os.path.getsize(path)
+                digests = hash_file(path)
+            except OSError as error:
+                problems.append(f"{entry['name']}: {error}")
+                continue
+            if size != entry["size"]:
+                problems.append(f"{entry['name']}: size {size} instead of {entry['size']}")
+            if digests["sha256"] != entry["sha256"]:
+                bad_chunks = [
+                    idx
+                    for idx, (found, expected) in enumerate(
+                        zip(digests["chunks_sha256"], entry.get("chunks_sha256", []))
+                    )
+                    if found != expected
+                ]
+                problems.append(
+                    f"{entry['name']}: sha256 mismatch"
+                    + (f", first modified MiB {bad_chunks[0]}" if bad_chunks else "")
+                )
+        return problems
+
+    def delete_incident(self, incident):
+        incident_path = os.path.join(self.legal_path, incident)
+        if not os.path.isfile(os.path.join(incident_path, IncidentStore.MANIFEST)):
+            raise ValueError(f"'{incident_path}' is no incident of this store")
+        shutil.rmtree(incident_path)
+        self._update_catalog("remove", incident)
+        # keep the grace period: blobs of an incident being saved right now
+        # are not referenced by its manifest yet
+        return self.gc()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the dashcam incident store.")
+    parser.add_argument(
+        "-l", "--legal_path", metavar="P", type=str, default="/opt/dashcam/legal",
+        help="Location of the legal (incident) folder."
+    )
+    parser.add_argument(
+        "-k", "--manifest_key_path", metavar="K", type=str,
+        default="/opt/dashcam/.manifest.key", help="Device key the manifests are signed with."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List incidents and their chunks.")
+    verify_parser = subparsers.add_parser(
+        "verify", help="Re-check signature and hashes of incidents (default: all)."
+    )
+    verify_parser.add_argument("incidents", nargs="*")
+    delete_parser = subparsers.add_parser("delete", help="Delete incidents and free their chunks.")
+    delete_parser.add_argument("incidents", nargs="+")
+    gc_parser = subparsers.add_parser("gc", help="Delete chunks no incident refers to.")
+    gc_parser.add_argument("--grace_seconds", type=int, default=3600)
+    args = parser.parse_args()
+
+    key_path = args.manifest_key_path if os.path.isfile(args.manifest_key_path) else None
+    catalog_path = os.path.join(args.legal_path, IncidentCatalog.FILENAME)
+    catalog = IncidentCatalog(catalog_path) if os.path.isfile(catalog_path) else None
+    store = IncidentStore(args.legal_path, key_path, catalog)
+    if args.command == "verify":
+        failed = 0
+        for incident in args.incidents or store.incidents():
+            problems = store.verify_incident(incident)
+            print(f"{incident}: {'OK' if not problems else 'FAILED'}")
+            for problem in problems:
+                print(f"    {problem}")
+            failed += bool(problems)
+        raise SystemExit(1 if failed else 0)
+    elif args.command == "list":
+        counts = store.reference_counts()
+        for incident in store.incidents():
+            manifest = store.read_manifest(incident)
+            print(incident)
+            for entry in manifest["files"]:
+                blob = os.path.join(store.legal_path, entry["blob"])
+                print(
+                    f"    {entry['name']} {entry['size']} bytes "
+                    f"sha256={entry['sha256'][:16]}... refs={counts.get(blob, 0)}"
+                )
+    elif args.command == "delete":
+        for incident in args.incidents:
+            deleted, freed = store.delete_incident(incident)
+            print(f"Deleted '{incident}', freed {deleted} chunks ({freed} bytes).")
+    elif args.command == "gc":
+        deleted, freed = store.gc(args.grace_seconds)
+        print(f"Freed {deleted} chunks ({freed} bytes).")
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()
@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+This module pushes the incidents of the legal folder to a sync endpoint via
+HTTP, e.g. a home server that is reachable once the car is back on the home
+Wi-Fi.
+Chunks are uploaded once per content (by SHA-256, as stored in the blob store)
+in resumable pieces: every PUT carries a Content-Range, the server offset can
+be queried with HEAD, and the progress of every file is kept in a state file,
+so an interrupted upload continues where it stopped. Every file is sent with
+its SHA-256, so files rewritten locally (e.g. merged manifests) replace the
+copy on the server. Network bandwidth and
+disk reads are throttled, so recording is not starved, and a few keep-alive
+connections are reused for all requests.
+Can also be used as stand-alone script to push once or to run a minimal
+local sync endpoint to test against.
+Classes:
+    TokenBucket
+    UploadState
+    Uploader
+    SyncRequestHandler
+Functions:
+    serve
+    main
+"""
+import os
+import json
+import hashlib
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from time import monotonic, sleep
+from urllib.parse import urlsplit, quote
+
+from store import IncidentStore
+
+UPLOAD_CHUNK_SIZE = 1<<20
+
+
+class TokenBucket():
+    """
+    Limits a rate in bytes per second, shared by all threads using it.
+    Keyword Arguments:
+        rate -- bytes per second; None or 0 disables the limit
+        burst -- bytes that may pass at once (default: None -> one second of rate)
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.tokens = self.burst
+        self.last_time = monotonic()
+        self.lock = Lock()
+
+    def consume(self, amount):
+        """
+        Blocks until amount bytes may pass.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            # go into debt instead of splitting the amount; the next caller waits
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            sleep(wait)
+
+
+class UploadState():
+    """
+    Persistent upload progress: per remote path the confirmed offset, size,
+    SHA-256 and whether the upload is complete. Written atomically on every change.
+    Keyword Arguments:
+        path -- JSON file of the state, e.g. legal/.upload_state.json
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        try:
+            with open(path) as file:
+                self.files = json.load(file)
+        except (OSError, ValueError):
+            self.files = {}
+
+    def get(self, remote_path):
+        with self.lock:
+            return dict(self.files.get(remote_path, {}))
+
+    def _write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.files, file, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def update(self, remote_path, **values):
+        with self.lock:
+            self.files.setdefault(remote_path, {}).update(values)
+            self._write()
+
+    def forget(self, keep_paths):
+        """
+        Drop the progress of remote paths not in keep_paths, e.g. of deleted incidents.
+        """
+        with self.lock:
+            removed = set(self.files) - set(keep_paths)
+            for remote_path in removed:
+                del self.files[remote_path]
+            if removed:
+                self._write()
+
+
+class Uploader():
+    """
+    Uploads all incidents (their chunks and manifests) of the legal folder.
+    Keyword Arguments:
+        legal_path -- the legal folder, e.g. /opt/dashcam/legal
+        endpoint -- base URL of the sync endpoint, e.g. http://nas.local:8080/dashcam
+        state_path -- upload progress file (default: None -> legal/.upload_state.json)
+        chunk_size -- bytes per PUT request (default: 1 MiB)
+        connections -- number of parallel uploads (default: 2)
+        bandwidth -- network limit in bytes per second (default: None -> unlimited)
+        read_rate -- disk read limit in bytes per second (default: None -> unlimited)
+        timeout -- socket timeout in seconds (default: 30)
+        metrics -- optional metrics.Metrics to count the upload in (default: None)
+    """
+    STATE_FILE = ".upload_state.json"
+
+    def __init__(
+            self, legal_path, endpoint, state_path=None, chunk_size=UPLOAD_CHUNK_SIZE,
+            connections=2, bandwidth=None, read_rate=None, timeout=30, metrics=None):
+        self.store = IncidentStore(legal_path)
+        self.endpoint = urlsplit(endpoint)
+        if self.endpoint.scheme not in ("http", "https"):
+            raise ValueError(f"Upload endpoint '{endpoint}' is no http(s) URL")
+        self.base_path = self.endpoint.path.rstrip("/")
+        self.state = UploadState(
+            state_path or os.path.join(legal_path, Uploader.STATE_FILE)
+        )
+        self.chunk_size = chunk_size
+        self.connections = max(1, connections)
+        self.bandwidth = TokenBucket(bandwidth)
+        self.read_rate = TokenBucket(read_rate)
+        self.timeout = timeout
+        self.metrics = metrics
+        self.local = local()
+
+    def _connection(self):
+        # one keep-alive connection per worker thread
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            if self.endpoint.scheme == "https":
+                connection = http.client.HTTPSConnection(
+                    self.endpoint.hostname, self.endpoint.port, timeout=self.timeout
+                )
+            else:
+                connection = http.client.HTTPConnection(
+                    self.endpoint.hostname, self.endpoint.port, timeout=self.timeout
+                )
+            self.local.connection = connection
+        return connection
+
+    def _request(self, method, remote_path, body=None, headers={}):
+        url = quote(f"{self.base_path}/{remote_path}")
+        # a reused connection may have been closed by the server meanwhile
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+                content = response.read()
+                return response, content
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                self.local.connection = None
+                if attempt:
+                    raise
+
+    def _count(self, name, value=1):
+        if self.metrics is not None:
+            self.metrics.increment(name, value)
+
+    def remote_offset(self, remote_path, sha256=None):
+        """
+        Keyword Arguments:
+            sha256 -- content to upload; a complete remote file of other
+                      content counts as nothing uploaded (default: None)
+        Returns: number of bytes the server already has of remote_path
+        """
+        response, _ = self._request("HEAD", remote_path)
+        if response.status == 404:
+            return 0
+        if response.status >= 300:
+            raise OSError(f"HEAD {remote_path}: {response.status} {response.reason}")
+        remote_sha256 = response.getheader("X-Content-SHA256")
+        if sha256 is not None and remote_sha256 is not None and remote_sha256 != sha256:
+            return 0
+        return int(response.getheader("Content-Length", 0))
+
+    def _read(self, file, size):
+        self.read_rate.consume(size)
+        data = file.read(size)
+        if hasattr(os, "posix_fadvise"):
+            # already sent data should not push the recording out of the page cache
+            os.posix_fadvise(file.fileno(), 0, file.tell(), os.POSIX_FADV_DONTNEED)
+        return data
+
+    def upload_file(self, path, remote_path, sha256=None):
+        """
+        Upload (or continue to upload) a local file to remote_path; a changed
+        local file is uploaded again and replaces the remote one.
+        Keyword Arguments:
+            sha256 -- SHA-256 of the file (default: None -> computed, for small files)
+        Returns: number of bytes sent
+        """
+        size = os.path.getsize(path)
+        if sha256 is None:
+            sha256 = _file_sha256(path)
+        progress = self.state.get(remote_path)
+        if (
+                progress.get("done") and progress.get("size") == size and
+                progress.get("sha256") == sha256):
+            return 0
+        # the server decides where to continue; the state only saves a request
+        # for files it already confirmed
+        offset = self.remote_offset(remote_path, sha256)
+        sent = 0
+        with open(path, "rb") as file:
+            file.seek(offset)
+            while offset < size:
+                data = self._read(file, min(self.chunk_size, size - offset))
+                self.bandwidth.consume(len(data))
+                headers = {
+                    "Content-Length": str(len(data)),
+                    "Content-Range": f"bytes {offset}-{offset + len(data) - 1}/{size}",
+                    "X-Content-SHA256": sha256,
+                }
+                response, _ = self._request("PUT", remote_path, data, headers)
+                if response.status == 409:
+                    # offsets got out of sync; continue where the server is
+                    offset = int(response.getheader("X-Upload-Offset", 0))
+                    file.seek(offset)
+                    continue
+                if response.status >= 300:
+                    raise OSError(f"PUT {remote_path}: {response.status} {response.reason}")
+                offset += len(data)
+                sent += len(data)
+                self._count("upload.bytes", len(data))
+                self.state.update(
+                    remote_path, offset=offset, size=size, sha256=sha256, done=False
+                )
+        if size == 0:
+            response, _ = self._request(
+                "PUT", remote_path, b"", {
+                    "Content-Length": "0", "Content-Range": "bytes */0",
+                    "X-Content-SHA256": sha256
+                }
+            )
+        self.state.update(remote_path, offset=size, size=size, sha256=sha256, done=True)
+        self._count("upload.files")
+        return sent
+
+    def _jobs(self):
+        # (local path, remote path, sha256); chunks first, manifests last, so
+        # an incident on the server is only complete if all its chunks are;
+        # manifests may be rewritten, their SHA-256 is taken when uploading
+        chunks, manifests = {}, []
+        for incident in self.store.incidents():
+            try:
+                manifest = self.store.read_manifest(incident)
+            except (OSError, ValueError) as error:
+                print(f"WARNING! Unreadable manifest of '{incident}': {error}")
+                continue
+            for entry in manifest.get("files", []):
+                blob = os.path.join(self.store.legal_path, entry["blob"])
+                remote_blob = f"blobs/{os.path.basename(blob)}"
+                chunks[remote_blob] = (blob, remote_blob, entry["sha256"])
+            manifests.append((
+                os.path.join(self.store.legal_path, incident, IncidentStore.MANIFEST),
+                f"incidents/{incident}/{IncidentStore.MANIFEST}", None
+            ))
+        return list(chunks.values()), manifests
+
+    def _upload_job(self, job):
+        path, remote_path, sha256 = job
+        try:
+            return self.upload_file(path, remote_path, sha256)
+        except FileNotFoundError:
+            # deleted (incident removed) while waiting for upload
+            return 0
+
+    def run_once(self):
+        """
+        Upload everything not yet on the server.
+        Returns: (number of files, bytes sent)
+        """
+        chunks, manifests = self._jobs()
+        self.state.forget([remote_path for _, remote_path, _ in chunks + manifests])
+        sent = 0
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            sent += sum(executor.map(self._upload_job, chunks))
+        # manifests are tiny; one connection is enough
+        for job in manifests:
+            sent += self._upload_job(job)
+        return len(chunks) + len(manifests), sent
+
+
+class SyncRequestHandler(BaseHTTPRequestHandler):
+    """
+    Minimal sync endpoint: HEAD returns the stored size of a file (and the
+    SHA-256 of a complete one), PUT with Content-Range appends at exactly that
+    offset (409 otherwise). Partial files are kept as <name>.part until
+    complete; a complete file is only replaced by an upload of other content.
+    """
+    protocol_version = "HTTP/1.1"
+    root = "."
+
+    def _paths(self):
+        relative = os.path.normpath(self.path.split("?", 1)[0].lstrip("/"))
+        if relative.startswith(".."):
+            return None, None
+        path = os.path.join(self.root, relative)
+        return path, f"{path}.part"
+
+    def _reply(self, status, headers={}):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        path, part_path = self._paths()
+        if path is None:
+            return self._reply(400)
+        # an upload in progress may be a new version of a complete file
+        if os.path.isfile(part_path):
+            return self._reply(200, {"Content-Length": str(os.path.getsize(part_path))})
+        if os.path.isfile(path):
+            return self._reply(200, {
+                "Content-Length": str(os.path.getsize(path)),
+                "X-Content-SHA256": _file_sha256(path)
+            })
+        self._reply(404)
+
+    def do_PUT(self):
+        path, part_path = self._paths()
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        if path is None:
+            return self._reply(400)
+        content_range = self.headers.get("Content-Range", f"bytes 0-{length - 1}/{length}")
+        try:
+            span, total = content_range.split(" ", 1)[1].split("/")
+            start = 0 if span == "*" else int(span.split("-")[0])
+            total = int(total)
+        except (IndexError, ValueError):
+            return self._reply(400)
+        sha256 = self.headers.get("X-Content-SHA256")
+        if (
+                os.path.isfile(path) and os.path.getsize(path) == total and
+                (sha256 is None or _file_sha256(path) == sha256)):
+            # already complete (e.g. the same chunk of another incident)
+            return self._reply(200)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        current = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        if start != current:
+            return self._reply(409, {"X-Upload-Offset": str(current)})
+        with open(part_path, "ab") as file:
+            file.write(data)
+        if current + len(data) >= total:
+            if sha256 is not None and _file_sha256(part_path) != sha256:
+                os.remove(part_path)
+                return self._reply(422)
+            os.replace(part_path, path)
+            return self._reply(201)
+        self._reply(202)
+
+
+def _file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def serve(root, port, host=""):
+    """
+    Run the minimal sync endpoint storing into root; blocks.
+    """
+    handler = type("Handler", (SyncRequestHandler,), {"root": root})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving uploads into '{root}' on port {port}.")
+    server.serve_forever()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Upload dashcam incidents to a sync endpoint.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    push_parser = subparsers.add_parser("push", help="Upload all incidents not yet uploaded.")
+    push_parser.add_argument(
+        "endpoint", metavar="URL", type=str,
+        help="Base URL of the sync endpoint, e.g. http://nas.local:8080/dashcam"
+    )
+    push_parser.add_argument(
+        "-l", "--legal_path", metavar="P", type=str, default="/opt/dashcam/legal",
+        help="Location of the legal (incident) folder."
+    )
+    push_parser.add_argument(
+        "--connections", metavar="N", type=int, default=2, help="Parallel uploads."
+    )
+    push_parser.add_argument(
+        "--bandwidth", metavar="B", type=int, default=None,
+        help="Upload limit in bytes per second."
+    )
+    push_parser.add_argument(
+        "--read_rate", metavar="B", type=int, default=None,
+        help="Disk read limit in bytes per second."
+    )
+    serve_parser = subparsers.add_parser("serve", help="Run a minimal local sync endpoint.")
+    serve_parser.add_argument("root", metavar="DIR", type=str, help="Folder to store uploads in.")
+    serve_parser.add_argument("-p", "--port", metavar="P", type=int, default=8080)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.root, args.port)
+    elif args.command == "push":
+        uploader = Uploader(
+            args.legal_path, args.endpoint, connections=args.connections,
+            bandwidth=args.bandwidth, read_rate=args.read_rate
+        )
+        start = monotonic()
+        files, sent = uploader.run_once()
+        print(f"Checked {files} files, sent {sent} bytes in {monotonic() - start:.1f}s.")
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    main()